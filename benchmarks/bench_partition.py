@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+/list_*_final partitioning: the serpentine deal against the balanced LPT split
+
+    python -m benchmarks.bench_partition [--channels 10000] [--lists 2 3 5 8]
+"""
+
+import time
+import argparse
+
+from promote_it import partition_serpentine, partition_balanced
+from benchmarks.datasets import synthetic_channels
+
+
+def summary(final_channels_list):
+    reaches = [sum(c.count for c in channels_list) for channels_list in final_channels_list]
+    sizes = [len(channels_list) for channels_list in final_channels_list]
+    return max(reaches) - min(reaches), max(sizes) - min(sizes)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="bench_partition")
+    parser.add_argument("--channels", type=int, default=10000)
+    parser.add_argument("--lists", type=int, nargs="+", default=[2, 3, 5, 8])
+    args = parser.parse_args()
+
+    channels_list = synthetic_channels(args.channels)
+    total = sum(c.count for c in channels_list)
+
+    schemes = [
+        ("serpentine", partition_serpentine),
+        ("lpt", lambda c, no: partition_balanced(c, no, improve=False)),
+        ("lpt+swaps", partition_balanced),
+    ]
+
+    print("%d channels, total reach %d" % (len(channels_list), total))
+    for no in args.lists:
+        for name, partition in schemes:
+            start = time.time()
+            final_channels_list = partition(channels_list, no)
+            elapsed = time.time() - start
+            reach_spread, size_spread = summary(final_channels_list)
+            print("%2d lists %-10s %.4fs  reach spread %8d (%.3f%% of a list)  size spread %d" %
+                  (no, name, elapsed, reach_spread, 100.0 * reach_spread * no / total, size_spread))
+
+
+if __name__ == '__main__':
+    main()
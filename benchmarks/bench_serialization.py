@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+channel record encoding against the pickle records it replaced
+
+    python -m benchmarks.bench_serialization [--channels 50000]
+"""
+
+import time
+import pickle
+import argparse
+
+from promote_it import Channels, encode_channel, decode_channel
+from benchmarks.datasets import synthetic_channels
+
+
+def timed(func):
+    start = time.time()
+    result = func()
+    return result, time.time() - start
+
+
+def load(records, decode):
+    channels = Channels()
+    for raw in records:
+        channels.add(decode(raw))
+    return channels
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="bench_serialization")
+    parser.add_argument("--channels", type=int, default=50000)
+    args = parser.parse_args()
+
+    channels_list = synthetic_channels(args.channels)
+
+    codecs = [
+        ("pickle", pickle.dumps, pickle.loads),
+        ("record_v1", encode_channel, decode_channel),
+    ]
+
+    for name, encode, decode in codecs:
+        records, store_time = timed(lambda: [encode(c) for c in channels_list])
+        _, load_time = timed(lambda: load(records, decode))
+        size = sum(len(raw) for raw in records)
+        print("%-10s store %.3fs  load %.3fs  %d bytes (%.1f per channel)" %
+              (name, store_time, load_time, size, float(size) / len(records)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+cold start: importing promote_it in a fresh interpreter, then the first app.channels load
+
+    python -m benchmarks.bench_startup [--runs 5]
+"""
+
+import sys
+import argparse
+import subprocess
+
+
+probe = """
+import time
+start = time.time()
+import promote_it
+imported = time.time()
+promote_it.app.channels
+loaded = time.time()
+print("%f %f" % (imported - start, loaded - imported))
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="bench_startup")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    imports = []
+    loads = []
+    for _ in range(args.runs):
+        output = subprocess.check_output([sys.executable, "-c", probe])
+        imported, loaded = output.split()[-2:]
+        imports.append(float(imported))
+        loads.append(float(loaded))
+
+    print("import       best %.3fs  worst %.3fs" % (min(imports), max(imports)))
+    print("first load   best %.3fs  worst %.3fs" % (min(loads), max(loads)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+regression check and microbenchmark for split_text, against the regex chain it replaced
+
+    python -m benchmarks.bench_tokenizer [--lines 2000] [--repeat 5]
+"""
+
+import re
+import sys
+import time
+import random
+import argparse
+
+from promote_it import split_text
+
+
+#############################################################################
+
+
+newp = re.compile('.*(#new).*(@\w+)(.*)')
+confirmp = re.compile('.*(#confirm).*(@\w+)(.*)')
+sharedp = re.compile('.*(#shared).*(@\w+)(.*)')
+removep = re.compile('.*(#remove).*(@\w+)(.*)')
+
+
+def legacy_handle_message(text):
+    text = " ".join(text.split('\n'))
+
+    for p in [newp, confirmp, sharedp, removep]:
+        m = p.match(text)
+        if m:
+            return m.group(1), m.group(2), m.group(3)
+
+    return None
+
+
+def legacy_split_text(text):
+    for hashtag in re.findall('.*(#\w+).*', text):
+        text = text.replace(hashtag, hashtag.lower())
+
+    texts = []
+
+    if "#new" in text:
+        for s in text.split("#new"):
+            if len(s) > 0:
+                s = "#new " + s
+                texts.append(s)
+
+    elif "#confirm" in text:
+        for s in re.findall(".*(\@\w+).*", text):
+            s = "#confirm " + s
+            texts.append(s)
+
+    elif "#shared" in text:
+        for s in re.findall(".*(\@\w+).*", text):
+            s = "#shared " + s
+            texts.append(s)
+
+    elif "#remove" in text:
+        for s in re.findall(".*(\@\w+).*", text):
+            s = "#remove " + s
+            texts.append(s)
+
+    else:
+        texts.append(text)
+
+    return texts
+
+
+def legacy_commands(text):
+    commands = []
+    for s in legacy_split_text(text):
+        command = legacy_handle_message(s)
+        if command is not None:
+            commands.append(command)
+    return commands
+
+
+def normalize(commands):
+    """ compares commands the way Channel sees them, desc only matters for #new """
+    result = []
+    for verb, name, desc in commands:
+        if verb != "#new":
+            desc = None
+        elif desc:
+            desc = desc.strip()
+        result.append((verb, name.strip(), desc))
+    return result
+
+
+#############################################################################
+
+
+words = ["best", "music", "movies", "daily", "news", "memes", "quotes", "join", "now", "free", "tips"]
+
+
+def random_desc(rnd):
+    return " ".join(rnd.choice(words) for _ in range(rnd.randint(0, 12)))
+
+
+def new_message(rnd, lines):
+    text = []
+    if rnd.random() < 0.3:
+        text.append("hey admin, channels for today @owner_%d" % rnd.randint(0, 99))
+    for i in range(lines):
+        verb = rnd.choice(["#new", "#new", "#New", "#NEW"])
+        entry = "%s @channel_%d %s" % (verb, rnd.randint(0, 100000), random_desc(rnd))
+        if rnd.random() < 0.2:
+            entry += "\n" + random_desc(rnd) + " mail me at me@example.com"
+        if rnd.random() < 0.1:
+            entry += "\n#news"
+        text.append(entry)
+    return "\n".join(text)
+
+
+def stage_message(rnd, verb, lines):
+    text = [verb.upper() if rnd.random() < 0.5 else verb]
+    for i in range(lines):
+        handles = " ".join("@channel_%d" % rnd.randint(0, 100000) for _ in range(rnd.randint(1, 3)))
+        text.append("%d. %s %s" % (i, random_desc(rnd), handles))
+    return "\n".join(text)
+
+
+def corpus(lines, seed=42):
+    rnd = random.Random(seed)
+    messages = [
+        "#new @solo",
+        "#new @solo great channel",
+        "#new",
+        "#confirm",
+        "just saying hi",
+        "#new @a@b trailing",
+        "#news only @news_channel",
+        "#confirm @one @two\n@three",
+        "#shared\n@x\n\n@y",
+        "#remove @gone",
+        u"#new @unicode_channel лучший канал",
+    ]
+    for _ in range(50):
+        messages.append(new_message(rnd, rnd.randint(1, 20)))
+        for verb in ["#confirm", "#shared", "#remove"]:
+            messages.append(stage_message(rnd, verb, rnd.randint(1, 20)))
+
+    big = [new_message(rnd, lines)] + [stage_message(rnd, verb, lines) for verb in ["#confirm", "#shared", "#remove"]]
+    return messages, big
+
+
+#############################################################################
+
+
+def check(messages):
+    mismatches = 0
+    for text in messages:
+        expected = normalize(legacy_commands(text))
+        actual = normalize(split_text(text))
+        if expected != actual:
+            mismatches = mismatches + 1
+            print("mismatch for %r\n  legacy %r\n  split_text %r" % (text, expected, actual))
+    return mismatches
+
+
+def timeit(func, messages, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        for text in messages:
+            func(text)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="bench_tokenizer")
+    parser.add_argument("--lines", type=int, default=2000, help="lines per large pasted message")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    messages, big = corpus(args.lines)
+
+    mismatches = check(messages + big)
+    print("regression corpus: %d messages, %d mismatches" % (len(messages) + len(big), mismatches))
+
+    for name, func in [("legacy", legacy_commands), ("split_text", split_text)]:
+        elapsed = timeit(func, big, args.repeat)
+        print("%-10s %d lines x %d messages: %.4fs" % (name, args.lines, len(big), elapsed))
+
+    if mismatches > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
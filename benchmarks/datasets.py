@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+
+"""
+synthetic channel datasets for the benchmarks
+"""
+
+import random
+
+from promote_it import Channel
+
+
+stages = [None, "#new", "#confirm", "#shared"]
+words = ["best", "music", "movies", "daily", "news", "memes", "quotes", "join", "now", "free", "tips"]
+
+
+def synthetic_channels(n, seed=42):
+    """ n channels with log-normal member counts, most small and a long tail of big ones """
+    rnd = random.Random(seed)
+    channels_list = []
+    for i in range(n):
+        count = int(rnd.lognormvariate(6.5, 1.4))
+        desc = " ".join(rnd.choice(words) for _ in range(rnd.randint(3, 20)))
+        date = None
+        if rnd.random() < 0.8:
+            date = 1500000000 + rnd.random() * 3600 * 24 * 30
+        channels_list.append(Channel("@channel_%d" % i, desc=desc, count=count, date=date,
+                                     stage=rnd.choice(stages)))
+    return channels_list
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+the core hot paths over synthetic datasets, with JSON results to diff across changes
+
+    python -m benchmarks.suite [--sizes 1000 10000 100000] [--repeat 3] [--backends redis sqlite memory]
+                               [--fake] [--output results.json]
+
+storage store/load/query runs once per backend: Redis on bench_ prefixed keys (fakeredis
+when --fake is given or no Redis answers), SQLite in a temporary file, and the in-memory
+store. results are one JSON document:
+
+    {"meta": {...}, "results": [{"bench": ..., "channels": ..., "best": ..., "mean": ..., "runs": ...}, ...]}
+"""
+
+import os
+import sys
+import json
+import logging
+import time
+import random
+import shutil
+import tempfile
+import platform
+import argparse
+import subprocess
+
+import redis
+
+import promote_it
+from promote_it import App, Channels, Database, SqliteDatabase, MemoryDatabase
+from promote_it import split_text, handle_message, on_list_final, partition_balanced
+from benchmarks.datasets import synthetic_channels, words
+
+
+connect = None
+
+
+class BenchDatabase(Database):
+    """ the real Database on bench_ prefixed keys, so a production Redis is never touched """
+
+    def __init__(self):
+        Database.__init__(self)
+        for attr in ["redis_key", "redis_archive_key", "records_key", "archive_records_key", "events_key",
+                     "journal_key", "snapshot_key", "snapshot_meta_key"]:
+            setattr(self, attr, "bench_" + getattr(self, attr))
+        self.rdb = connect()
+
+    def drop(self):
+        self.rdb.delete(self.redis_key, self.redis_archive_key, self.records_key, self.archive_records_key,
+                        self.journal_key, self.snapshot_key, self.snapshot_meta_key)
+
+
+class Message(object):
+    chat_id = 1
+
+    def reply_text(self, text):
+        pass
+
+
+class Update(object):
+    def __init__(self, text=""):
+        self.message = Message()
+        self.message.text = text
+
+
+def redis_factory(fake):
+    if not fake:
+        try:
+            rdb = redis.StrictRedis(connection_pool=promote_it.redis_pool())
+            rdb.ping()
+            return "redis", lambda: redis.StrictRedis(connection_pool=promote_it.redis_pool())
+        except redis.ConnectionError:
+            pass
+
+    import fakeredis
+
+    class FakeRoundTripConnection(promote_it.RoundTripConnection, fakeredis.FakeConnection):
+        pass
+
+    pool = redis.ConnectionPool(connection_class=FakeRoundTripConnection, server=fakeredis.FakeServer())
+    return "fakeredis", lambda: redis.StrictRedis(connection_pool=pool)
+
+
+def measure(func, repeat, setup=None):
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return times
+
+
+def install(channels_list):
+    """ a fresh app holding channels_list, with every lookup answered from the cache """
+    promote_it.app = App(database=BenchDatabase)
+    channels = Channels()
+    for channel in channels_list:
+        channels.add(channel)
+        promote_it.app.lookup_cache.put(promote_it.app.lookup_cache.key(channel.name),
+                                        (channel.count, channel.name, channel.date or time.time()))
+    promote_it.app.loaded = channels
+    channels.watch(promote_it.app.list_cache.changed)
+    return promote_it.app
+
+
+def paste(channels_list, lines, seed=42):
+    """ one large pasted message per verb, naming only channels of the dataset so no lookup leaves the cache """
+    rnd = random.Random(seed)
+    names = [c.name for c in channels_list]
+
+    entries = ["#new %s %s" % (rnd.choice(names), " ".join(rnd.choice(words) for _ in range(rnd.randint(0, 12))))
+               for _ in range(lines)]
+    texts = ["\n".join(entries)]
+    for verb in ["#confirm", "#shared"]:
+        texts.append("\n".join([verb] + ["%d. %s" % (i, rnd.choice(names)) for i in range(lines)]))
+    return texts
+
+
+def bench_storage(db, channels, drop, repeat, add):
+    buckets = [(0, 500), (500, 1000), (1000, 5000), (5000, sys.maxsize)]
+
+    def trips(op):
+        """ round-trips of the last call, where the backend counts them """
+        if not hasattr(db, "roundtrips"):
+            return {}
+        return {"roundtrips": db.roundtrips.get(op)}
+
+    # a store without indexes answers query() with a full load
+    query = "query" if db.indexed else "load"
+
+    add("storage.store", measure(lambda: db.store(channels), repeat, setup=drop), **trips("store"))
+    add("storage.load", measure(db.load, repeat), **trips("load"))
+    add("storage.query_range", measure(lambda: [db.query(l, h) for l, h in buckets], repeat), **trips(query))
+    add("storage.query_stage", measure(lambda: [db.query(l, h, stage="#confirm") for l, h in buckets], repeat),
+        **trips(query))
+    drop()
+
+
+def bench_size(n, repeat, lines, backends):
+    channels_list = synthetic_channels(n)
+    app = install(channels_list)
+    results = []
+
+    def add(bench, times, **extra):
+        result = {"bench": bench, "channels": n, "runs": len(times), "best": min(times),
+                  "mean": sum(times) / len(times)}
+        result.update(extra)
+        results.append(result)
+
+    def add_for(backend):
+        return lambda bench, times, **extra: add(bench, times, backend=backend, **extra)
+
+    buckets = [(0, 500), (500, 1000), (1000, 5000), (5000, sys.maxsize)]
+
+    add("channels.range_names", measure(lambda: [app.channels.range_names(l, h) for l, h in buckets], repeat))
+    add("channels.range_list", measure(lambda: [app.channels.range_list(l, h) for l, h in buckets], repeat))
+    add("channels.query_stage", measure(lambda: [app.channels.query(l, h, stage="#confirm") for l, h in buckets],
+                                        repeat))
+
+    texts = paste(channels_list, lines)
+    add("split_text", measure(lambda: [split_text(text) for text in texts], repeat), lines=lines)
+
+    def handle():
+        update = Update()
+        with promote_it.app.db.batch():
+            for text in texts:
+                for command in split_text(text):
+                    handle_message(None, update, command)
+
+    add("split_text+handle_message", measure(handle, repeat, setup=lambda: install(channels_list)), lines=lines)
+    app = promote_it.app
+
+    emojis = [u"🔥", u"💎", u"🚀", u"⭐", u"🎯"]
+    confirmed = app.channels.query(0, sys.maxsize, stage="#confirm")
+    add("partition_balanced", measure(lambda: partition_balanced(confirmed, len(emojis)), repeat),
+        lists=len(emojis), partitioned=len(confirmed))
+    add("on_list_final", measure(lambda: on_list_final(None, Update(), "all", 0, sys.maxsize,
+                                                       [str(len(emojis))] + emojis), repeat),
+        lists=len(emojis), partitioned=len(confirmed))
+
+    if "redis" in backends:
+        db = app.db.db
+        bench_storage(db, app.channels, db.drop, repeat, add_for("redis"))
+
+    if "sqlite" in backends:
+        directory = tempfile.mkdtemp()
+        try:
+            db = SqliteDatabase(os.path.join(directory, "bench.db"))
+            drop = lambda: db.conn.executescript("DELETE FROM channels; DELETE FROM journal;")
+            bench_storage(db, app.channels, drop, repeat, add_for("sqlite"))
+            db.conn.close()
+        finally:
+            shutil.rmtree(directory)
+
+    if "memory" in backends:
+        db = MemoryDatabase()
+        bench_storage(db, app.channels, lambda: db.records.clear(), repeat, add_for("memory"))
+
+    return results
+
+
+def revision():
+    try:
+        with open(os.devnull, "w") as devnull:
+            output = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=devnull,
+                                             cwd=os.path.dirname(os.path.abspath(promote_it.__file__)))
+        return output.strip().decode("ascii")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="suite")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--lines", type=int, default=2000, help="lines per large pasted message")
+    parser.add_argument("--backends", nargs="+", default=["redis", "sqlite", "memory"],
+                        choices=["redis", "sqlite", "memory"], help="storage backends to compare")
+    parser.add_argument("--fake", action="store_true", help="use fakeredis even if a local Redis answers")
+    parser.add_argument("--output", help="write the JSON here instead of stdout")
+    args = parser.parse_args()
+
+    global connect
+    promote_it.logger.setLevel(logging.WARNING)
+    redis_backend, connect = redis_factory(args.fake)
+
+    results = []
+    for n in args.sizes:
+        results.extend(bench_size(n, args.repeat, args.lines, args.backends))
+        sys.stderr.write("%d channels done\n" % n)
+
+    document = {
+        "meta": {"revision": revision(), "python": platform.python_version(), "redis": redis_backend,
+                 "repeat": args.repeat, "lines": args.lines, "date": time.time()},
+        "results": results,
+    }
+
+    text = json.dumps(document, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
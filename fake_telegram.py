@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+a local stand-in for the parts of the telegram bot api promote_it uses: getMe,
+getUpdates (and setWebhook, which polling calls first), sendMessage, getChat and
+getChatMembersCount. it serves a synthetic channel population, adds latency,
+injects flood control (429 retry_after) and feeds scripted admin messages as
+updates, so the bot and the refresher can be load tested offline:
+
+    python fake_telegram.py --port 8081 --channels 100000 --latency 0.05 --flood-rate 0.01 --script msgs.txt
+    TELEGRAM_BASE_URL=http://127.0.0.1:8081/bot python promote_it.py start
+"""
+
+import re
+import sys
+import json
+import time
+import random
+import logging
+import itertools
+import argparse
+import threading
+import collections
+import SocketServer
+import BaseHTTPServer
+
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    level=logging.INFO)
+logger = logging.getLogger("fake_telegram")
+
+pathp = re.compile('^/bot([^/]+)/(\w+)$')
+
+
+#############################################################################
+
+
+class Population(object):
+    """ channels by lower cased username, with log-normal member counts """
+
+    def __init__(self, n, seed=42, prefix="channel_"):
+        rnd = random.Random(seed)
+        self.channels = {}
+        for i in range(n):
+            username = "%s%d" % (prefix, i)
+            self.channels[username.lower()] = (-1000000000000 - i, username, int(rnd.lognormvariate(6.5, 1.4)))
+
+    def get(self, chat_id):
+        return self.channels.get(unicode(chat_id).lstrip("@").lower())
+
+
+class Updates(object):
+    """ scripted admin messages handed out through getUpdates, long polling like telegram does """
+
+    def __init__(self, chat_id, user_id, username):
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.username = username
+        self.updates = collections.deque()
+        self.next_id = 1
+        self.cond = threading.Condition()
+
+    def push(self, text):
+        with self.cond:
+            update_id = self.next_id
+            self.next_id = self.next_id + 1
+            self.updates.append({
+                "update_id": update_id,
+                "message": {
+                    "message_id": update_id,
+                    "date": int(time.time()),
+                    "chat": {"id": self.chat_id, "type": "private", "username": self.username},
+                    "from": {"id": self.user_id, "is_bot": False, "first_name": self.username,
+                             "username": self.username},
+                    "text": text,
+                },
+            })
+            self.cond.notify_all()
+
+    def get(self, offset, limit, timeout):
+        deadline = time.time() + timeout
+        with self.cond:
+            while True:
+                while len(self.updates) > 0 and self.updates[0]["update_id"] < offset:
+                    self.updates.popleft()
+
+                if len(self.updates) > 0 or time.time() >= deadline:
+                    return list(itertools.islice(self.updates, limit))
+
+                self.cond.wait(deadline - time.time())
+
+
+class Stats(object):
+    def __init__(self):
+        self.calls = collections.Counter()
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    def add(self, key):
+        with self.lock:
+            self.calls[key] += 1
+
+    def report(self):
+        with self.lock:
+            elapsed = time.time() - self.started
+            return ", ".join("%s %d (%.1f/s)" % (key, count, count / elapsed)
+                             for key, count in sorted(self.calls.items()))
+
+
+#############################################################################
+
+
+class FakeTelegram(object):
+    def __init__(self, population, updates, latency=0, jitter=0, flood_rate=0, retry_after=1, bot_rate=None):
+        self.population = population
+        self.updates = updates
+        self.latency = latency
+        self.jitter = jitter
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.bot_rate = bot_rate
+        self.next_call = {}
+        self.message_id = 0
+        self.stats = Stats()
+        self.lock = threading.Lock()
+
+    def flooded(self, token):
+        """ True when this call gets a 429, at random or because the bot is over bot_rate calls a second """
+        if self.flood_rate > 0 and random.random() < self.flood_rate:
+            return True
+
+        if self.bot_rate is None:
+            return False
+
+        with self.lock:
+            now = time.time()
+            if self.next_call.get(token, 0) > now:
+                return True
+            self.next_call[token] = now + 1.0 / self.bot_rate
+            return False
+
+    def call(self, token, method, params):
+        """ (http status, response body) for one api call """
+        if method != "getUpdates" and self.latency + self.jitter > 0:
+            time.sleep(max(0, random.uniform(self.latency - self.jitter, self.latency + self.jitter)))
+
+        if method != "getUpdates" and self.flooded(token):
+            self.stats.add("429")
+            return 429, {"ok": False, "error_code": 429,
+                         "description": "Too Many Requests: retry after %d" % self.retry_after,
+                         "parameters": {"retry_after": self.retry_after}}
+
+        self.stats.add(method)
+        handler = getattr(self, "on_" + method, None)
+        if handler is None:
+            return 404, {"ok": False, "error_code": 404, "description": "Not Found: method not found"}
+        return handler(token, params)
+
+    def ok(self, result):
+        return 200, {"ok": True, "result": result}
+
+    def chat_not_found(self):
+        return 400, {"ok": False, "error_code": 400, "description": "Bad Request: chat not found"}
+
+    def on_getMe(self, token, params):
+        return self.ok({"id": int(token.split(":")[0]), "is_bot": True, "first_name": "fake",
+                        "username": "fake_%s_bot" % token.split(":")[0]})
+
+    def on_getUpdates(self, token, params):
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        timeout = min(float(params.get("timeout") or 0), 30)
+        return self.ok(self.updates.get(offset, limit, timeout))
+
+    def on_setWebhook(self, token, params):
+        """ start_polling clears the webhook first """
+        return self.ok(True)
+
+    def on_deleteWebhook(self, token, params):
+        return self.ok(True)
+
+    def on_sendMessage(self, token, params):
+        with self.lock:
+            self.message_id = self.message_id + 1
+            message_id = self.message_id
+        return self.ok({"message_id": message_id, "date": int(time.time()), "text": params.get("text"),
+                        "chat": {"id": params.get("chat_id"), "type": "private"}})
+
+    def on_getChat(self, token, params):
+        channel = self.population.get(params.get("chat_id"))
+        if channel is None:
+            return self.chat_not_found()
+        chat_id, username, count = channel
+        return self.ok({"id": chat_id, "type": "channel", "title": username, "username": username})
+
+    def on_getChatMembersCount(self, token, params):
+        channel = self.population.get(params.get("chat_id"))
+        if channel is None:
+            return self.chat_not_found()
+        return self.ok(channel[2])
+
+
+def handler_for(fake):
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def answer(self, params):
+            m = pathp.match(self.path.split("?")[0])
+            if m is None:
+                status, body = 404, {"ok": False, "error_code": 404, "description": "Not Found"}
+            else:
+                status, body = fake.call(m.group(1), m.group(2), params)
+
+            raw = json.dumps(body)
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(raw)))
+            self.end_headers()
+            self.wfile.write(raw)
+
+        def do_GET(self):
+            self.answer({})
+
+        def do_POST(self):
+            length = int(self.headers.getheader("content-length") or 0)
+            params = {}
+            if length > 0:
+                params = json.loads(self.rfile.read(length))
+            self.answer(params)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def read_script(path):
+    """ one message per line, a literal \\n inside a line stands for a line break """
+    with open(path) as f:
+        return [line.rstrip("\n").decode("utf-8").replace("\\n", "\n") for line in f if line.strip()]
+
+
+def feed(updates, messages, rate, repeat):
+    """ pushes messages as updates, rate a second, repeat times over """
+    for _ in range(repeat):
+        for text in messages:
+            updates.push(text)
+            if rate:
+                time.sleep(1.0 / rate)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="fake_telegram.py")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--channels", type=int, default=10000, help="synthetic channels @channel_0 .. @channel_<n-1>")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--latency", type=float, default=0, help="secs added to every api call")
+    parser.add_argument("--jitter", type=float, default=0, help="+- secs of random latency")
+    parser.add_argument("--flood-rate", type=float, default=0, help="share of calls answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after secs in a 429")
+    parser.add_argument("--bot-rate", type=float, default=None, help="calls a second per bot before 429s")
+    parser.add_argument("--script", default=None, help="file of admin messages to feed through getUpdates")
+    parser.add_argument("--rate", type=float, default=None, help="scripted messages a second, default all at once")
+    parser.add_argument("--repeat", type=int, default=1, help="times to feed the script")
+    parser.add_argument("--chat-id", type=int, default=1)
+    parser.add_argument("--user-id", type=int, default=1)
+    parser.add_argument("--username", default="admin")
+    parser.add_argument("--report", type=int, default=10, help="log call rates every secs")
+    args = parser.parse_args()
+
+    population = Population(args.channels, args.seed)
+    updates = Updates(args.chat_id, args.user_id, args.username)
+    fake = FakeTelegram(population, updates, args.latency, args.jitter, args.flood_rate, args.retry_after,
+                        args.bot_rate)
+
+    server = Server((args.host, args.port), handler_for(fake))
+    worker = threading.Thread(target=server.serve_forever)
+    worker.daemon = True
+    worker.start()
+    logger.info("fake telegram on http://%s:%d/bot with [%d] channels" % (args.host, args.port, args.channels))
+
+    if args.script:
+        feeder = threading.Thread(target=feed, args=(updates, read_script(args.script), args.rate, args.repeat))
+        feeder.daemon = True
+        feeder.start()
+
+    try:
+        while True:
+            time.sleep(args.report)
+            logger.info(fake.stats.report())
+    except KeyboardInterrupt:
+        logger.info(fake.stats.report())
+        sys.exit()
+
+
+if __name__ == '__main__':
+    main()
@@ -2,32 +2,51 @@
 # -*- coding: utf-8 -*-
 
 
+import os
 import time
+import random
 import sys
 import re
 import logging
 import pickle
+import struct
 import redis
 import itertools
+import bisect
+import heapq
+import threading
+import argparse
+import Queue
+import atexit
+import contextlib
+import collections
+import uuid
+import functools
+import BaseHTTPServer
+import json
+import cProfile
+import pstats
+import sqlite3
 
 from tgbots import get_random_bot, is_admin
+import telegram
 from telegram import TelegramError
+from telegram.error import NetworkError, BadRequest, RetryAfter
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
                     level=logging.INFO)
 logger = logging.getLogger("crosspromo")
 
-newp = re.compile('.*(#new).*(@\w+)(.*)')
-confirmp = re.compile('.*(#confirm).*(@\w+)(.*)')
-sharedp = re.compile('.*(#shared).*(@\w+)(.*)')
-removep = re.compile('.*(#remove).*(@\w+)(.*)')
-listp = re.compile('.*(#list)(.*)')
+tokenp = re.compile('#\w+|@\w+|\n')
+verbs = ["#new", "#confirm", "#shared", "#remove"]
 
 
 #############################################################################
 
 
 class Channel(object):
+    __slots__ = ["name", "desc", "count", "date", "stage"]
+
     def __init__(self, name, desc=None, count=0, date=None, stage=None):
         self.name = name.strip()
         self.desc = desc
@@ -42,6 +61,9 @@ class Channel(object):
     def update_count(self, count):
         self.count = count
 
+    def update_date(self, date):
+        self.date = date
+
     def log(self):
         logger.info("channel - [%s], [%s], [%d], [%s]" % (self.name, self.desc, self.count, self.stage))
 
@@ -67,13 +89,223 @@ class Channel(object):
         msg = "%s\n%s" % (self.name, self.desc)
         return msg
 
+    def __getstate__(self):
+        return dict((slot, getattr(self, slot)) for slot in self.__slots__)
+
+    def __setstate__(self, state):
+        # pickles made before __slots__ carry the plain instance __dict__
+        if isinstance(state, tuple):
+            state = dict(state[0] or {}, **(state[1] or {}))
+
+        for slot in self.__slots__:
+            setattr(self, slot, state.get(slot))
+
+
+# channel record, version 1:
+#   "\0" <version:B> <count:q> <date:d> <flags:B>, then name and the
+#   flagged desc and stage, each as <length:I> <utf-8 bytes>
+record_version = 1
+record_header = struct.Struct("<cBqdB")
+record_length = struct.Struct("<I")
+record_date, record_desc, record_stage = 1, 2, 4
+
+
+def encode_text(value):
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    return record_length.pack(len(value)) + value
+
+
+def decode_text(raw, offset):
+    length, = record_length.unpack_from(raw, offset)
+    offset = offset + record_length.size
+    return raw[offset:offset + length].decode("utf-8"), offset + length
+
+
+def encode_channel(channel):
+    flags = 0
+    if channel.date is not None:
+        flags = flags | record_date
+    if channel.desc is not None:
+        flags = flags | record_desc
+    if channel.stage is not None:
+        flags = flags | record_stage
+
+    raw = [record_header.pack("\0", record_version, channel.count, channel.date or 0, flags),
+           encode_text(channel.name)]
+    if flags & record_desc:
+        raw.append(encode_text(channel.desc))
+    if flags & record_stage:
+        raw.append(encode_text(channel.stage))
+    return "".join(raw)
+
+
+def decode_channel(raw):
+    # a pickle never starts with a NUL byte, so anything else is a pre-version-1 record
+    if raw[:1] != "\0":
+        return pickle.loads(raw)
+
+    _, version, count, date, flags = record_header.unpack_from(raw)
+    if version != record_version:
+        raise ValueError("unsupported channel record version [%d]" % version)
+
+    name, offset = decode_text(raw, record_header.size)
+
+    desc = None
+    if flags & record_desc:
+        desc, offset = decode_text(raw, offset)
+
+    stage = None
+    if flags & record_stage:
+        stage, offset = decode_text(raw, offset)
+
+    if not flags & record_date:
+        date = None
+
+    return Channel(name, desc=desc, count=count, date=date, stage=stage)
+
+
+class CountIndex(object):
+    """
+    channel names kept sorted by count, highest first, for bisect range lookups.
+    counts (name -> count) given up front are sorted once rather than inserted one by one
+    """
+
+    def __init__(self, counts=None):
+        self.counts = dict(counts or {})
+        self.keys = sorted((-count, name) for name, count in self.counts.items())
+        self.negated = [negated for negated, _ in self.keys]
+
+    def add(self, name, count):
+        if self.counts.has_key(name):
+            self.remove(name)
+
+        i = bisect.bisect_left(self.keys, (-count, name))
+        self.keys.insert(i, (-count, name))
+        self.negated.insert(i, -count)
+        self.counts[name] = count
+
+    def remove(self, name):
+        if not self.counts.has_key(name):
+            return
+
+        i = bisect.bisect_left(self.keys, (-self.counts.pop(name), name))
+        del self.keys[i]
+        del self.negated[i]
+
+    def names(self):
+        return [name for _, name in self.keys]
+
+    def range_bounds(self, low, high):
+        return bisect.bisect_right(self.negated, -high), bisect.bisect_right(self.negated, -low)
+
+    def range_keys(self, low, high):
+        start, end = self.range_bounds(low, high)
+        return self.keys[start:end]
+
+    def range_names(self, low, high):
+        return [name for _, name in self.range_keys(low, high)]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def clear(self):
+        self.counts.clear()
+        del self.keys[:]
+        del self.negated[:]
+
+
+class BucketStats(object):
+    """ running number of channels and member sum per (count bucket, stage), kept up to date by Channels.watch """
+
+    def __init__(self, bounds=(0, 500, 1000, 5000)):
+        self.bounds = list(bounds)
+        self.totals = {}
+
+    def bucket(self, count):
+        return self.bounds[max(0, bisect.bisect_right(self.bounds, count) - 1)]
+
+    def label(self, low):
+        i = self.bounds.index(low)
+        if i + 1 < len(self.bounds):
+            return "%d_%d" % (low, self.bounds[i + 1])
+        return "%d_plus" % low
+
+    def changed(self, name, before, after):
+        if before is not None:
+            self.add(before, -1)
+        if after is not None:
+            self.add(after, 1)
+
+    def add(self, state, sign):
+        count, stage = state
+        key = (self.bucket(count), stage)
+        totals = self.totals.setdefault(key, [0, 0])
+        totals[0] = totals[0] + sign
+        totals[1] = totals[1] + sign * count
+        if totals[0] == 0:
+            del self.totals[key]
+
+    def rows(self):
+        """ (bucket label, stage, channels, members), by bucket then stage """
+        return [(self.label(low), stage, totals[0], totals[1])
+                for (low, stage), totals in sorted(self.totals.items())]
+
 
 class Channels(object):
-    def __init__(self):
+    def __init__(self, channels_list=None):
+        """ channels_list, e.g. a whole load, is indexed with one sort per index instead of an add per channel """
         self.channels = {}
+        self.index = CountIndex()
+        self.stages = {}
+        self.stats = BucketStats()
+        self.observers = [self.stats.changed]
+        self.lock = threading.RLock()
+
+        if channels_list is not None:
+            for channel in channels_list:
+                self.channels[channel.name] = channel
+
+            stages = {}
+            for name, channel in self.channels.items():
+                stages.setdefault(channel.stage, {})[name] = channel.count
+                self.notify(name, None, self.state(name))
+            self.index = CountIndex(dict((name, channel.count) for name, channel in self.channels.items()))
+            self.stages = dict((stage, CountIndex(counts)) for stage, counts in stages.items())
+
+    def watch(self, observer):
+        """ observer(name, before, after) is called with the (count, stage) of a channel around every change """
+        self.observers.append(observer)
+
+    def notify(self, name, before, after):
+        for observer in self.observers:
+            observer(name, before, after)
+
+    def state(self, name):
+        channel = self.channels.get(name)
+        if channel is None:
+            return None
+        return channel.count, channel.stage
 
     def add(self, channel):
-        self.channels[channel.name] = channel
+        with self.lock:
+            before = self.state(channel.name)
+            if before is not None:
+                self.unindex_stage(channel.name, before[1])
+            self.channels[channel.name] = channel
+            self.index.add(channel.name, channel.count)
+            self.index_stage(channel)
+            self.notify(channel.name, before, self.state(channel.name))
+
+    def index_stage(self, channel):
+        if not self.stages.has_key(channel.stage):
+            self.stages[channel.stage] = CountIndex()
+        self.stages[channel.stage].add(channel.name, channel.count)
+
+    def unindex_stage(self, name, stage):
+        self.stages[stage].remove(name)
+        if len(self.stages[stage]) == 0:
+            del self.stages[stage]
 
     def get(self, channel):
         if self.channels.has_key(channel.name):
@@ -82,77 +314,1419 @@ class Channels(object):
             return None
 
     def remove(self, channel):
-        if self.channels.has_key(channel.name):
-            del self.channels[channel.name]
-            return True
-        else:
-            return False
+        with self.lock:
+            if self.channels.has_key(channel.name):
+                before = self.state(channel.name)
+                del self.channels[channel.name]
+                self.index.remove(channel.name)
+                self.unindex_stage(channel.name, before[1])
+                self.notify(channel.name, before, None)
+                return True
+            else:
+                return False
+
+    def update_stage(self, channel, stage):
+        with self.lock:
+            if self.channels.get(channel.name) is not channel:
+                channel.update_stage(stage)
+                return
+
+            before = self.state(channel.name)
+            self.unindex_stage(channel.name, channel.stage)
+            channel.update_stage(stage)
+            self.index_stage(channel)
+            self.notify(channel.name, before, self.state(channel.name))
+
+    def update_count(self, channel, count):
+        with self.lock:
+            if self.channels.get(channel.name) is not channel:
+                channel.update_count(count)
+                return
+
+            before = self.state(channel.name)
+            channel.update_count(count)
+            self.index.add(channel.name, count)
+            self.stages[channel.stage].add(channel.name, count)
+            self.notify(channel.name, before, self.state(channel.name))
 
     def list(self):
-        channels_list = self.channels.values()
-        channels_list.sort(key=lambda x: x.count, reverse=True)
-        return channels_list
+        with self.lock:
+            return [self.channels[name] for name in self.index.names()]
 
     def range_list(self, low, high):
-        channels_list = []
-
-        names = self.range_names(low, high)
-        for name in names:
-            channels_list.append(self.channels[name])
-
-        return channels_list
+        with self.lock:
+            return [self.channels[name] for name in self.range_names(low, high)]
 
     def names(self):
         return self.channels.keys()
 
+    def query(self, low, high, stage=None, exclude=None):
+        """
+        channels with count in [low, high), highest first, only those in stage /
+        not in exclude when given. a stage is answered from its own count index,
+        an exclude by merging the bucket of every other stage, so both cost
+        O(log n + k) in the channels returned rather than the whole bucket.
+        """
+        with self.lock:
+            if stage is not None:
+                if not self.stages.has_key(stage):
+                    return []
+                names = self.stages[stage].range_names(low, high)
+            elif exclude is not None:
+                buckets = [index.range_keys(low, high) for s, index in self.stages.items() if s != exclude]
+                names = [name for _, name in heapq.merge(*buckets)]
+            else:
+                names = self.range_names(low, high)
+
+            return [self.channels[name] for name in names]
+
     def range_names(self, low, high):
-        names = []
+        with self.lock:
+            return self.index.range_names(low, high)
+
+    def stale_list(self, before):
+        """ channels not refreshed since before, oldest first, never refreshed ones leading """
+        with self.lock:
+            channels_list = [c for c in self.channels.values() if c.date is None or c.date < before]
+        channels_list.sort(key=lambda x: x.date or 0)
+        return channels_list
+
+    def clear(self):
+        with self.lock:
+            states = [(name, self.state(name)) for name in self.channels.keys()]
+            self.channels.clear()
+            self.index.clear()
+            self.stages.clear()
+            for name, before in states:
+                self.notify(name, before, None)
 
-        for channel in self.list():
-            if channel.count >= low and channel.count < high:
-                names.append(channel.name)
 
-        return names
+class ListCache(object):
+    """ rendered /list_* messages keyed by (view, type, low, high), dropped when a channel in the bucket changes """
+
+    def __init__(self):
+        self.entries = {}
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            return self.entries.get(key), self.generation
+
+    def put(self, key, messages, generation):
+        with self.lock:
+            # skip renders that raced with a change to the channels
+            if generation == self.generation:
+                self.entries[key] = messages
+
+    def changed(self, name, before, after):
+        counts = [state[0] for state in (before, after) if state is not None]
+
+        with self.lock:
+            self.generation = self.generation + 1
+            for key in self.entries.keys():
+                view, type, low, high = key
+                for count in counts:
+                    if low <= count < high:
+                        del self.entries[key]
+                        break
 
     def clear(self):
-        self.channels.clear()
+        with self.lock:
+            self.generation = self.generation + 1
+            self.entries.clear()
+
+
+class Histogram(object):
+    """ per bucket counts, made cumulative only when rendered, plus sum and count """
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum = self.sum + value
+        self.count = self.count + 1
+
+
+class Metrics(object):
+    """
+    counters and latency histograms keyed by name and labels. off by default, and
+    while off every entry point returns before taking the lock or the time.
+    """
+
+    latency_bounds = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def count(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.latency_bounds)
+            histogram.observe(value)
+
+    def call(self, name, func, **labels):
+        """ func(), its latency in <name>_seconds and its outcome (ok or the exception class) in <name>_total """
+        if not self.enabled:
+            return func()
+
+        start = time.time()
+        result = "ok"
+        try:
+            return func()
+        except Exception as e:
+            result = e.__class__.__name__
+            raise
+        finally:
+            self.observe(name + "_seconds", time.time() - start, **labels)
+            labels["result"] = result
+            self.count(name + "_total", **labels)
+
+    def render(self):
+        """ everything recorded so far in the prometheus text format """
+        def format_labels(labels):
+            if len(labels) == 0:
+                return ""
+            return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in labels)
+
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append("%s%s %s" % (name, format_labels(labels), value))
+
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                total = 0
+                for bound, count in zip(self.latency_bounds + ["+Inf"], histogram.counts):
+                    total = total + count
+                    lines.append("%s_bucket%s %d" % (name, format_labels(labels + (("le", bound),)), total))
+                lines.append("%s_sum%s %f" % (name, format_labels(labels), histogram.sum))
+                lines.append("%s_count%s %d" % (name, format_labels(labels), histogram.count))
+
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port, host="127.0.0.1"):
+        """ answers GET /metrics on host:port from a daemon thread """
+        metrics = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.enabled = True
+        server = BaseHTTPServer.HTTPServer((host, port), Handler)
+        worker = threading.Thread(target=server.serve_forever)
+        worker.daemon = True
+        worker.start()
+        logger.info("serving metrics on http://%s:%d/metrics" % (host, port))
+        return server
+
+    def dump_every(self, interval):
+        """ logs everything recorded every interval secs from a daemon thread """
+        def run():
+            while True:
+                time.sleep(interval)
+                logger.info("metrics\n%s" % self.render())
+
+        self.enabled = True
+        worker = threading.Thread(target=run)
+        worker.daemon = True
+        worker.start()
+
+
+metrics = Metrics()
+
+
+def timed(name, **labels):
+    """ decorator passing every call of func through metrics.call """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return metrics.call(name, lambda: func(*args, **kwargs), **labels)
+        return wrapper
+    return decorator
+
+
+class RoundTrips(threading.local):
+    """ requests this thread sent to Redis during the Database op being counted """
 
+    def __init__(self):
+        self.op = None
+        self.count = 0
+
+
+roundtrips = RoundTrips()
+
+
+class RoundTripConnection(redis.Connection):
+    """ counts every request it writes, a single command or a whole pipeline, as one round-trip """
+
+    def send_packed_command(self, command, *args, **kwargs):
+        roundtrips.count = roundtrips.count + 1
+        return super(RoundTripConnection, self).send_packed_command(command, *args, **kwargs)
+
+
+def redis_op(op):
+    """
+    Database method decorator: latency through metrics.call, and the round-trips
+    of the outermost op on this thread in db.roundtrips[op] and redis_roundtrips_total
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            call = lambda: metrics.call("redis", lambda: func(self, *args, **kwargs), op=op)
+            if roundtrips.op is not None:
+                return call()
+
+            roundtrips.op = op
+            roundtrips.count = 0
+            try:
+                return call()
+            finally:
+                self.roundtrips[op] = roundtrips.count
+                metrics.count("redis_roundtrips_total", roundtrips.count, op=op)
+                roundtrips.op = None
+        return wrapper
+    return decorator
+
+
+redis_url = os.environ.get("PROMOTE_IT_REDIS_URL", "redis://localhost:6379/0")
+redis_max_connections = int(os.environ.get("PROMOTE_IT_REDIS_MAX_CONNECTIONS", 16))
+redis_pools = {}
+journal_retention_days = float(os.environ.get("PROMOTE_IT_JOURNAL_RETENTION_DAYS", 7))
+redis_pools_lock = threading.Lock()
+
+
+def redis_pool(url=None, max_connections=None):
+    """
+    the connection pool for url, shared by every Database and thread in the
+    process. once max_connections are out, callers wait for one to come back.
+    """
+    url = url or redis_url
+    with redis_pools_lock:
+        pool = redis_pools.get(url)
+        if pool is None:
+            pool = redis.BlockingConnectionPool.from_url(url, max_connections=max_connections or redis_max_connections,
+                                                         timeout=20, connection_class=RoundTripConnection)
+            redis_pools[url] = pool
+        return pool
+
+
+def bot_label(tgbot):
+    """ the bot id part of the token, so metrics never carry the secret half """
+    token = getattr(tgbot, "token", None)
+    if not token:
+        return "unknown"
+    return token.split(":")[0]
+
+
+class Storage(object):
+    """
+    what App needs from a channel store. Database, MemoryDatabase and SqliteDatabase
+    implement load, store, write, rename, archive and clean over their own store;
+    the rest is shared here. indexed is True when query() runs inside the store
+    rather than over a full load, so list views are worth sending to it.
+    """
+
+    indexed = False
+
+    def store_channel(self, channel, fields=None):
+        self.write({channel.name: (channel, fields)})
+
+    def delete_channel(self, channel):
+        self.write({channel.name: None})
+
+    def merge(self, stored, channel, fields):
+        """ the encoded stored record, decoded, with fields taken from channel """
+        current = decode_channel(stored)
+        for field in fields:
+            setattr(current, field, getattr(channel, field))
+        return current
+
+    def renamed(self, stored, target, channel, fields):
+        """
+        the record a rename leaves at channel.name: the encoded target already there
+        keeps its own fields and takes only fields from channel, the old alias being
+        dropped; with no target the stored record moves over
+        """
+        if target is not None:
+            return self.merge(target, channel, fields)
+        current = self.merge(stored, channel, fields)
+        current.name = channel.name
+        return current
+
+    def decode(self, records):
+        return Channels([decode_channel(raw) for raw in records])
+
+    def fold(self, entries, set, delete, clear):
+        """ applies journal entries (date, origin, op, name, raw) through set(name, raw), delete(name) and clear() """
+        for date, origin, op, name, raw in entries:
+            if op == "set":
+                set(name, raw)
+            elif op == "del":
+                delete(name)
+            elif op == "clear":
+                clear()
+
+    def rebuild(self, records, entries, until=None):
+        """ Channels of records (name -> encoded record) after the journal entries up to until """
+        if until is not None:
+            entries = itertools.takewhile(lambda entry: entry[0] <= until, entries)
+        self.fold(entries, records.__setitem__, lambda name: records.pop(name, None), records.clear)
+        return self.decode(records.values())
+
+    def journal(self, start=0, end=-1):
+        return []
+
+    def compact(self, before=None):
+        return 0
+
+    def replay(self, until=None):
+        return self.load()
+
+    def query(self, low, high, stage=None, exclude=None):
+        """ like Channels.query, filtering a full load """
+        return self.load().query(low, high, stage, exclude)
+
+    def feed(self, apply):
+        return None
+
+    def migrate(self):
+        return 0
+
+
+class Database(Storage):
+    """
+    channel records in Redis. MemoryDatabase and SqliteDatabase share its Storage
+    methods, so App can run on any of them (see database_from_url).
+    """
 
-class Database(object):
     def __init__(self):
         self.redis_key = "promo_channels"
         self.redis_archive_key = "promo_channels_archive"
-        self.rdb = redis.StrictRedis(host='localhost', port=6379, db=0)
-
+        self.records_key = "promo_channels_records"
+        self.archive_records_key = "promo_channels_archive_records"
+        self.events_key = "promo_channels_events"
+        self.journal_key = "promo_channels_journal"
+        self.snapshot_key = "promo_channels_snapshot"
+        self.snapshot_meta_key = "promo_channels_snapshot_meta"
+        self.origin = uuid.uuid4().hex
+        self.roundtrips = {}
+        self.rdb = redis.StrictRedis(connection_pool=redis_pool())
+
+    @redis_op("load")
     def load(self):
+        pipe = self.rdb.pipeline(transaction=False)
+        pipe.exists(self.records_key)
+        pipe.exists(self.redis_key)
+        pipe.hvals(self.records_key)
+        has_records, has_legacy, records = pipe.execute()
+
+        if not has_records and has_legacy:
+            self.migrate()
+            records = self.rdb.hvals(self.records_key)
+        if metrics.enabled:
+            metrics.count("redis_bytes_total", sum(len(raw) for raw in records), op="load")
+        return self.decode(records)
+
+    @redis_op("store")
+    def store(self, channels):
+        self.replace(self.records_key, channels)
+
+    @redis_op("write")
+    def write(self, records):
+        """
+        stores (channel, fields) or deletes (None) many records in one transaction.
+
+        with fields set only those fields are merged into the stored record, under
+        WATCH, so fields another process owns survive; the merge is dropped when
+        the record was deleted meanwhile. fields None writes the whole record.
+        """
+        merged = [name for name, record in records.items() if record is not None and record[1] is not None]
+
+        def transaction(pipe):
+            size = 0
+            stored = {}
+            if len(merged) > 0:
+                stored = dict(zip(merged, pipe.hmget(self.records_key, merged)))
+
+            pipe.multi()
+            for name, record in records.items():
+                if record is None:
+                    pipe.hdel(self.records_key, name)
+                    self.changed(pipe, "del", name)
+                    continue
+
+                channel, fields = record
+                if fields is not None:
+                    if stored[name] is None:
+                        continue
+                    channel = self.merge(stored[name], channel, fields)
+
+                raw = encode_channel(channel)
+                pipe.hset(self.records_key, name, raw)
+                self.changed(pipe, "set", name, raw, fields)
+                size = size + len(raw)
+            return size
+
+        watches = []
+        if len(merged) > 0:
+            watches.append(self.records_key)
+        size = self.transaction("write", transaction, *watches)
+        metrics.count("redis_bytes_total", size, op="write")
+
+    @redis_op("rename")
+    def rename(self, name, channel, fields):
+        """
+        moves the stored record at name to channel.name with fields taken from
+        channel, under WATCH; False, and nothing written, when name is gone. a
+        record already at channel.name is kept and only merged (see renamed)
+        """
+        def transaction(pipe):
+            stored, target = pipe.hmget(self.records_key, [name, channel.name])
+            if stored is None:
+                return None
+
+            raw = encode_channel(self.renamed(stored, target, channel, fields))
+
+            pipe.multi()
+            pipe.hdel(self.records_key, name)
+            self.changed(pipe, "del", name)
+            pipe.hset(self.records_key, channel.name, raw)
+            self.changed(pipe, "set", channel.name, raw)
+            return len(raw)
+
+        size = self.transaction("rename", transaction, self.records_key)
+        if size is None:
+            return False
+        metrics.count("redis_bytes_total", size, op="rename")
+        return True
+
+    @redis_op("archive")
+    def archive(self, channels):
+        self.replace(self.archive_records_key, channels)
+
+    @redis_op("clean")
+    def clean(self, channels):
+        """ archives channels and clears the records in one MULTI/EXEC round-trip """
+        pipe = self.rdb.pipeline()
+        self.replace(self.archive_records_key, channels, pipe)
+        self.replace(self.records_key, Channels(), pipe)
+        pipe.execute()
+
+    def replace(self, key, channels, pipe=None):
+        """ swaps the hash at key for channels; queued on pipe when given, else sent at once """
+        entries = [self.entry("clear", "")]
+        size = 0
+
+        execute = pipe is None
+        if execute:
+            pipe = self.rdb.pipeline()
+        pipe.delete(key)
+        for channel in channels.list():
+            raw = encode_channel(channel)
+            pipe.hset(key, channel.name, raw)
+            entries.append(self.entry("set", channel.name, raw))
+            size = size + len(raw)
+
+        metrics.count("redis_bytes_total", size, op="store" if key == self.records_key else "archive")
+
+        if key == self.records_key:
+            pipe.rpush(self.journal_key, *entries)
+            pipe.publish(self.events_key, self.event("reload", ""))
+        if execute:
+            pipe.execute()
+
+    def transaction(self, op, func, *watches):
+        """
+        rdb.transaction(func, *watches), returning what func returns. func runs again
+        on every WatchError, so it only collects; the WATCH retries go to
+        redis_retries_total once the transaction went through
+        """
+        attempts = []
+
+        def attempt(pipe):
+            attempts.append(1)
+            return func(pipe)
+
+        try:
+            return self.rdb.transaction(attempt, *watches, value_from_callable=True)
+        finally:
+            metrics.count("redis_retries_total", max(0, len(attempts) - 1), op=op)
+
+    def event(self, op, name, raw=""):
+        if isinstance(name, unicode):
+            name = name.encode("utf-8")
+        return "%s\n%s\n%s\n%s" % (self.origin, op, name, raw)
+
+    def entry(self, op, name, raw=""):
+        return "%.6f\n%s" % (time.time(), self.event(op, name, raw))
+
+    def changed(self, pipe, op, name, raw="", fields=None):
+        """
+        publishes a record change to other processes and appends it to the journal.
+        a field merge goes out as a merge event naming its fields, so followers copy
+        only those and keep the rest of their (possibly newer) record
+        """
+        if fields is None:
+            pipe.publish(self.events_key, self.event(op, name, raw))
+        else:
+            pipe.publish(self.events_key, self.event("merge", name, "%s\n%s" % (",".join(fields), raw)))
+        pipe.rpush(self.journal_key, self.entry(op, name, raw))
+
+    @redis_op("journal")
+    def journal(self, start=0, end=-1):
+        return [decode_entry(entry) for entry in self.rdb.lrange(self.journal_key, start, end)]
+
+    @redis_op("compact")
+    def compact(self, before=None, batch=1000):
+        """ folds the journal entries older than before (unix time, all when None) into the snapshot, batch
+            entries per transaction; returns how many were folded """
+        def transaction(pipe):
+            entries = [decode_entry(entry) for entry in pipe.lrange(self.journal_key, 0, batch - 1)]
+            if before is not None:
+                entries = list(itertools.takewhile(lambda entry: entry[0] < before, entries))
+
+            pipe.multi()
+            self.fold(entries, lambda name, raw: pipe.hset(self.snapshot_key, name, raw),
+                      lambda name: pipe.hdel(self.snapshot_key, name), lambda: pipe.delete(self.snapshot_key))
+
+            if len(entries) > 0:
+                pipe.ltrim(self.journal_key, len(entries), -1)
+                pipe.hincrby(self.snapshot_meta_key, "entries", len(entries))
+                pipe.hset(self.snapshot_meta_key, "date", repr(entries[-1][0]))
+            return len(entries)
+
+        folded = 0
+        while True:
+            count = self.transaction("compact", transaction, self.snapshot_meta_key)
+            folded = folded + count
+            if count < batch:
+                break
+
+        logger.info("compacted [%d] journal entries into [%s]" % (folded, self.snapshot_key))
+        return folded
+
+    @redis_op("replay")
+    def replay(self, until=None):
+        """ channels rebuilt from the snapshot and the journal entries after it, up to until (unix time) """
+        pipe = self.rdb.pipeline()
+        pipe.hgetall(self.snapshot_meta_key)
+        pipe.hgetall(self.snapshot_key)
+        pipe.lrange(self.journal_key, 0, -1)
+        meta, snapshot, entries = pipe.execute()
+
+        if until is not None and float(meta.get("date", 0)) > until:
+            raise ValueError("journal already compacted past [%s]" % until)
+
+        records = dict((name.decode("utf-8"), raw) for name, raw in snapshot.items())
+        return self.rebuild(records, [decode_entry(entry) for entry in entries], until)
+
+    def feed(self, apply):
+        return ChangeFeed(self, apply)
+
+    @redis_op("migrate")
+    def migrate(self):
+        """ one-shot conversion of the pickled promo_channels blob into per channel records """
         raw = self.rdb.get(self.redis_key)
-        if raw:
-            return pickle.loads(raw)
+        if not raw:
+            return 0
+
+        legacy = pickle.loads(raw)
+        channels = Channels(legacy.channels.values())
+
+        self.store(channels)
+        self.rdb.rename(self.redis_key, self.redis_key + "_legacy")
+
+        logger.info("migrated [%d] channels from [%s] to [%s]" % (len(channels.names()), self.redis_key, self.records_key))
+        return len(channels.names())
+
+
+class MemoryDatabase(Storage):
+    """ Storage over a dict of encoded records, for replays that must not touch Redis """
+
+    def __init__(self):
+        self.records = {}
+        self.archived = {}
+
+    def load(self):
+        return self.decode(self.records.values())
+
+    def store(self, channels):
+        self.records = dict((c.name, encode_channel(c)) for c in channels.list())
+
+    def write(self, records):
+        for name, record in records.items():
+            if record is None:
+                self.records.pop(name, None)
+                continue
+
+            channel, fields = record
+            if fields is not None:
+                if name not in self.records:
+                    continue
+                channel = self.merge(self.records[name], channel, fields)
+            self.records[name] = encode_channel(channel)
+
+    def rename(self, name, channel, fields):
+        if name not in self.records:
+            return False
+        current = self.renamed(self.records.pop(name), self.records.get(channel.name), channel, fields)
+        self.records[channel.name] = encode_channel(current)
+        return True
+
+    def archive(self, channels):
+        self.archived = dict((c.name, encode_channel(c)) for c in channels.list())
+
+    def clean(self, channels):
+        self.archive(channels)
+        self.records = {}
+
+
+sqlite_schema = """
+PRAGMA journal_mode=WAL;
+CREATE TABLE IF NOT EXISTS channels (name TEXT PRIMARY KEY, count INTEGER NOT NULL, stage TEXT, date REAL,
+                                     record BLOB NOT NULL);
+CREATE INDEX IF NOT EXISTS channels_count ON channels (count);
+CREATE INDEX IF NOT EXISTS channels_stage_count ON channels (stage, count);
+CREATE TABLE IF NOT EXISTS archived_channels (name TEXT PRIMARY KEY, record BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS journal (id INTEGER PRIMARY KEY AUTOINCREMENT, date REAL NOT NULL, origin TEXT,
+                                    op TEXT NOT NULL, name TEXT, record BLOB);
+CREATE TABLE IF NOT EXISTS snapshot (name TEXT PRIMARY KEY, record BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS snapshot_meta (key TEXT PRIMARY KEY, value);
+"""
+
+
+class SqliteDatabase(Storage):
+    """
+    Storage on an embedded SQLite file, for deployments without Redis. count and
+    stage sit in indexed columns next to the encoded record, so query() runs
+    inside the store. there is no change feed between processes.
+    """
+
+    indexed = True
+
+    def __init__(self, path="promo_channels.db"):
+        self.path = path
+        self.origin = uuid.uuid4().hex
+        # autocommit, so transaction() decides where a transaction starts, reads included
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.lock = threading.RLock()
+        with self.lock:
+            self.conn.executescript(sqlite_schema)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        a cursor inside BEGIN IMMEDIATE, committed on success and rolled back on error.
+        the write lock is taken before the first SELECT, so a read-merge-write cannot
+        interleave with another process's write
+        """
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                yield cursor
+            except:
+                cursor.execute("ROLLBACK")
+                raise
+            cursor.execute("COMMIT")
+
+    def row(self, channel):
+        raw = encode_channel(channel)
+        return channel.name, channel.count, channel.stage, channel.date, buffer(raw)
+
+    def log(self, cursor, op, name, raw=None):
+        if raw is not None:
+            raw = buffer(raw)
+        cursor.execute("INSERT INTO journal (date, origin, op, name, record) VALUES (?, ?, ?, ?, ?)",
+                       (time.time(), self.origin, op, name, raw))
+
+    @timed("sqlite", op="load")
+    def load(self):
+        with self.lock:
+            records = [str(raw) for raw, in self.conn.execute("SELECT record FROM channels")]
+        if metrics.enabled:
+            metrics.count("sqlite_bytes_total", sum(len(raw) for raw in records), op="load")
+        return self.decode(records)
+
+    @timed("sqlite", op="store")
+    def store(self, channels):
+        rows = [self.row(channel) for channel in channels.list()]
+        with self.transaction() as cursor:
+            cursor.execute("DELETE FROM channels")
+            cursor.executemany("INSERT INTO channels (name, count, stage, date, record) VALUES (?, ?, ?, ?, ?)", rows)
+            self.log(cursor, "clear", "")
+            cursor.executemany("INSERT INTO journal (date, origin, op, name, record) VALUES (?, ?, 'set', ?, ?)",
+                               [(time.time(), self.origin, row[0], row[4]) for row in rows])
+        metrics.count("sqlite_bytes_total", sum(len(row[4]) for row in rows), op="store")
+
+    @timed("sqlite", op="write")
+    def write(self, records):
+        """ Database.write in one SQLite transaction, merges included """
+        with self.transaction() as cursor:
+            for name, record in records.items():
+                if record is None:
+                    cursor.execute("DELETE FROM channels WHERE name = ?", (name,))
+                    self.log(cursor, "del", name)
+                    continue
+
+                channel, fields = record
+                if fields is not None:
+                    stored = cursor.execute("SELECT record FROM channels WHERE name = ?", (name,)).fetchone()
+                    if stored is None:
+                        continue
+                    channel = self.merge(str(stored[0]), channel, fields)
+
+                row = self.row(channel)
+                cursor.execute("INSERT OR REPLACE INTO channels (name, count, stage, date, record) VALUES (?, ?, ?, ?, ?)",
+                               row)
+                self.log(cursor, "set", name, row[4])
+                metrics.count("sqlite_bytes_total", len(row[4]), op="write")
+
+    @timed("sqlite", op="rename")
+    def rename(self, name, channel, fields):
+        """ Database.rename in one SQLite transaction """
+        with self.transaction() as cursor:
+            stored = cursor.execute("SELECT record FROM channels WHERE name = ?", (name,)).fetchone()
+            if stored is None:
+                return False
+            target = cursor.execute("SELECT record FROM channels WHERE name = ?", (channel.name,)).fetchone()
+            if target is not None:
+                target = str(target[0])
+
+            row = self.row(self.renamed(str(stored[0]), target, channel, fields))
+            cursor.execute("DELETE FROM channels WHERE name = ?", (name,))
+            self.log(cursor, "del", name)
+            cursor.execute("INSERT OR REPLACE INTO channels (name, count, stage, date, record) VALUES (?, ?, ?, ?, ?)",
+                           row)
+            self.log(cursor, "set", channel.name, row[4])
+            return True
+
+    @timed("sqlite", op="archive")
+    def archive(self, channels):
+        with self.transaction() as cursor:
+            cursor.execute("DELETE FROM archived_channels")
+            cursor.executemany("INSERT INTO archived_channels (name, record) VALUES (?, ?)",
+                               [(c.name, buffer(encode_channel(c))) for c in channels.list()])
+
+    @timed("sqlite", op="clean")
+    def clean(self, channels):
+        """ archives channels and clears the records in one transaction """
+        rows = [(c.name, buffer(encode_channel(c))) for c in channels.list()]
+        with self.transaction() as cursor:
+            cursor.execute("DELETE FROM archived_channels")
+            cursor.executemany("INSERT INTO archived_channels (name, record) VALUES (?, ?)", rows)
+            cursor.execute("DELETE FROM channels")
+            self.log(cursor, "clear", "")
+
+    @timed("sqlite", op="query")
+    def query(self, low, high, stage=None, exclude=None):
+        """ Channels.query answered from the count and (stage, count) indexes """
+        sql = "SELECT record FROM channels WHERE count >= ? AND count < ?"
+        params = [low, high]
+        if stage is not None:
+            sql += " AND stage = ?"
+            params.append(stage)
+        if exclude is not None:
+            sql += " AND stage IS NOT ?"
+            params.append(exclude)
+        sql += " ORDER BY count DESC, name"
+
+        with self.lock:
+            records = [str(raw) for raw, in self.conn.execute(sql, params)]
+        return [decode_channel(raw) for raw in records]
+
+    def entries(self, start=0, end=-1):
+        """ journal rows as (id, date, origin, op, name, raw), sliced like Redis LRANGE """
+        with self.lock:
+            rows = self.conn.execute("SELECT id, date, origin, op, name, record FROM journal ORDER BY id").fetchall()
+        if end == -1:
+            rows = rows[start:]
         else:
-            return Channels()
+            rows = rows[start:end + 1]
+        return [(id, date, origin, op, name, str(raw) if raw is not None else "")
+                for id, date, origin, op, name, raw in rows]
+
+    @timed("sqlite", op="journal")
+    def journal(self, start=0, end=-1):
+        return [entry[1:] for entry in self.entries(start, end)]
+
+    @timed("sqlite", op="compact")
+    def compact(self, before=None):
+        """ folds the journal entries older than before (unix time, all when None) into the snapshot table in
+            one transaction; returns how many entries were folded """
+        with self.transaction() as cursor:
+            entries = self.entries()
+            if before is not None:
+                entries = list(itertools.takewhile(lambda entry: entry[1] < before, entries))
+            self.fold([entry[1:] for entry in entries],
+                      lambda name, raw: cursor.execute("INSERT OR REPLACE INTO snapshot (name, record) VALUES (?, ?)",
+                                                       (name, buffer(raw))),
+                      lambda name: cursor.execute("DELETE FROM snapshot WHERE name = ?", (name,)),
+                      lambda: cursor.execute("DELETE FROM snapshot"))
+
+            if len(entries) > 0:
+                cursor.execute("DELETE FROM journal WHERE id <= ?", (entries[-1][0],))
+                folded = cursor.execute("SELECT value FROM snapshot_meta WHERE key = 'entries'").fetchone()
+                cursor.execute("INSERT OR REPLACE INTO snapshot_meta (key, value) VALUES ('entries', ?)",
+                               ((folded[0] if folded else 0) + len(entries),))
+                cursor.execute("INSERT OR REPLACE INTO snapshot_meta (key, value) VALUES ('date', ?)",
+                               (entries[-1][1],))
+
+        logger.info("compacted [%d] journal entries into [%s]" % (len(entries), self.path))
+        return len(entries)
+
+    @timed("sqlite", op="replay")
+    def replay(self, until=None):
+        """ Database.replay: the snapshot table plus the journal after it, up to until """
+        with self.transaction():
+            meta = dict(self.conn.execute("SELECT key, value FROM snapshot_meta").fetchall())
+            records = dict((name, str(raw)) for name, raw in self.conn.execute("SELECT name, record FROM snapshot"))
+            entries = self.entries()
+
+        if until is not None and float(meta.get("date", 0)) > until:
+            raise ValueError("journal already compacted past [%s]" % until)
+        return self.rebuild(records, [entry[1:] for entry in entries], until)
+
+
+def database_from_url(url):
+    """ the storage named by url: redis (the default), memory, or sqlite:<path> """
+    if url is None or url == "redis":
+        return Database
+    if url == "memory":
+        return MemoryDatabase
+    if url.startswith("sqlite:"):
+        path = url[len("sqlite:"):] or "promo_channels.db"
+        return lambda: SqliteDatabase(path)
+    raise ValueError("unknown storage [%s], expected redis, memory or sqlite:<path>" % url)
+
+
+def decode_event(payload):
+    origin, op, name, raw = payload.split("\n", 3)
+    return origin, op, name.decode("utf-8"), raw
+
+
+def decode_entry(entry):
+    date, event = entry.split("\n", 1)
+    return (float(date),) + decode_event(event)
+
+
+class ChangeFeed(object):
+    """ follows the channel writes other processes publish through Database and hands them to apply """
+
+    def __init__(self, db, apply):
+        self.db = db
+        self.apply = apply
+        self.pubsub = None
+
+    def start(self):
+        self.pubsub = self.db.rdb.pubsub(ignore_subscribe_messages=True)
+        self.pubsub.subscribe(self.db.events_key)
+
+        worker = threading.Thread(target=self.run)
+        worker.daemon = True
+        worker.start()
+
+    def run(self):
+        while True:
+            try:
+                self.listen()
+            except redis.RedisError as e:
+                logger.error("change feed lost - %s" % e)
+                self.resubscribe()
+
+    def listen(self):
+        for message in self.pubsub.listen():
+            if message["type"] != "message":
+                continue
+
+            origin, op, name, raw = decode_event(message["data"])
+            if origin == self.db.origin:
+                continue
+
+            try:
+                self.apply(op, name, raw)
+            except Exception:
+                logger.exception("failed to apply [%s] for [%s]" % (op, name))
+
+    def resubscribe(self, max_delay=60):
+        """ subscribes again, backing off while Redis is away, then reloads to pick up whatever was missed """
+        delay = 1
+        while True:
+            try:
+                self.pubsub.close()
+                self.pubsub = self.db.rdb.pubsub(ignore_subscribe_messages=True)
+                self.pubsub.subscribe(self.db.events_key)
+                self.apply("reload", "", "")
+                logger.info("change feed resubscribed")
+                return
+            except redis.RedisError as e:
+                logger.error("change feed resubscribe failed, retry in [%d] secs - %s" % (delay, e))
+                time.sleep(delay)
+                delay = min(max_delay, delay * 2)
+
+
+class WriteBehind(object):
+    """ coalesces channel writes into one storage write per batch, or per max_delay secs """
+
+    def __init__(self, db, max_delay=120):
+        self.db = db
+        self.max_delay = max_delay
+        self.dirty = {}
+        self.dirty_since = None
+        self.batches = threading.local()
+        self.lock = threading.RLock()
+
+    def load(self):
+        return self.db.load()
 
     def store(self, channels):
-        self.rdb.set(self.redis_key, pickle.dumps(channels))
+        with self.lock:
+            self.dirty.clear()
+            self.dirty_since = None
+            self.db.store(channels)
 
     def archive(self, channels):
-        self.rdb.set(self.redis_archive_key, pickle.dumps(channels))
-        
+        self.flush()
+        self.db.archive(channels)
+
+    def clean(self, channels):
+        with self.lock:
+            self.flush()
+            self.db.clean(channels)
+
+    def migrate(self):
+        return self.db.migrate()
+
+    def journal(self, start=0, end=-1):
+        return self.db.journal(start, end)
+
+    def compact(self, before=None):
+        self.flush()
+        return self.db.compact(before)
+
+    def replay(self, until=None):
+        self.flush()
+        return self.db.replay(until)
+
+    @property
+    def indexed(self):
+        return self.db.indexed
+
+    def query(self, low, high, stage=None, exclude=None):
+        self.flush()
+        return self.db.query(low, high, stage, exclude)
+
+    def store_channel(self, channel, fields=None):
+        self.mark(channel.name, (channel, fields))
+
+    def delete_channel(self, channel):
+        self.mark(channel.name, None)
+
+    def rename(self, name, channel, fields):
+        """ goes straight to the storage, after whatever is pending, so it reads the latest record at name """
+        with self.lock:
+            self.flush()
+            return self.db.rename(name, channel, fields)
+
+    def combine(self, pending, record):
+        """ the one record to write for pending followed by record; a field merge on top widens to what pending wrote """
+        if record is None or record[1] is None:
+            return record
+        if pending is None or pending[1] is None:
+            return (record[0], None)
+        return (record[0], sorted(set(pending[1]) | set(record[1])))
+
+    def mark(self, name, record):
+        with self.lock:
+            if self.dirty.has_key(name):
+                record = self.combine(self.dirty[name], record)
+
+            self.dirty[name] = record
+            if self.dirty_since is None:
+                self.dirty_since = time.time()
+
+            if self.depth() == 0 or time.time() - self.dirty_since >= self.max_delay:
+                self.flush()
+
+    def flush(self):
+        with self.lock:
+            if len(self.dirty) == 0:
+                return
+
+            records = self.dirty
+            dirty_since = self.dirty_since
+            self.dirty = {}
+            self.dirty_since = None
+            try:
+                self.db.write(records)
+            except Exception:
+                for name, record in records.items():
+                    if self.dirty.has_key(name):
+                        record = self.combine(record, self.dirty[name])
+                    self.dirty[name] = record
+                self.dirty_since = dirty_since
+                raise
+            logger.info("flushed [%d] channel records" % len(records))
+
+    @contextlib.contextmanager
+    def batch(self):
+        """ holds this thread's writes until the outermost batch ends; other threads still write through """
+        self.batches.depth = self.depth() + 1
+        try:
+            yield self
+        finally:
+            self.batches.depth = self.depth() - 1
+            if self.depth() == 0:
+                self.flush()
+
+    def depth(self):
+        return getattr(self.batches, "depth", 0)
+
+
+class LookupFlight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class LookupCache(object):
+    """ telegram lookups per handle kept for ttl secs, concurrent misses on a handle share one fetch """
+
+    def __init__(self, ttl=600, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = {}
+        self.flights = {}
+        self.lock = threading.Lock()
+
+    def key(self, name):
+        return name.strip().lstrip("@").lower()
+
+    def get(self, name, fetch, bypass=False):
+        key = self.key(name)
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if not bypass and entry is not None and entry[0] > time.time():
+                return entry[1]
+
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = LookupFlight()
+                self.flights[key] = flight
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = fetch()
+            self.put(key, flight.value)
+            return flight.value
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+
+    def put(self, key, value):
+        with self.lock:
+            now = time.time()
+            if len(self.entries) >= self.max_entries:
+                for expired in [k for k, entry in self.entries.items() if entry[0] <= now]:
+                    del self.entries[expired]
+            self.entries[key] = (now + self.ttl, value)
+
+
+class RateLimiter(object):
+    """ spaces out the telegram calls made through one bot """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.next_call = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+
+        if delay > 0:
+            time.sleep(delay)
+
+    def defer(self, delay):
+        """ holds off the next call, e.g. for telegram flood control """
+        with self.lock:
+            self.next_call = max(self.next_call, time.time() + delay)
+
+
+class Outbox(object):
+    """
+    replies queued per chat and sent in order by one worker thread, at most one
+    per chat every per_chat_interval secs and global_rate a second overall
+    """
+
+    def __init__(self, per_chat_interval=1, global_rate=30):
+        self.per_chat_interval = per_chat_interval
+        self.limiter = RateLimiter(1.0 / global_rate)
+        self.pending = {}
+        self.ready = {}
+        self.cond = threading.Condition()
+        self.worker = None
+        self.stopping = False
+
+    def start(self):
+        self.stopping = False
+        self.worker = threading.Thread(target=self.run)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def stop(self):
+        """ sends whatever is still queued, then stops the worker """
+        if self.worker is None:
+            return
+
+        with self.cond:
+            self.stopping = True
+            self.cond.notify()
+        self.worker.join()
+        self.worker = None
+
+    def send(self, message, text):
+        if self.worker is None:
+            return self.deliver(message, text)
+
+        with self.cond:
+            self.pending.setdefault(message.chat_id, collections.deque()).append((message, text))
+            self.cond.notify()
+
+    def next(self):
+        with self.cond:
+            while True:
+                if len(self.pending) == 0:
+                    if self.stopping:
+                        return None
+                    self.cond.wait()
+                    continue
+
+                chat_id = min(self.pending.keys(), key=lambda x: self.ready.get(x, 0))
+                delay = self.ready.get(chat_id, 0) - time.time()
+                if delay > 0:
+                    self.cond.wait(delay)
+                    continue
+
+                queue = self.pending[chat_id]
+                item = queue.popleft()
+                if len(queue) == 0:
+                    del self.pending[chat_id]
+                self.ready[chat_id] = time.time() + self.per_chat_interval
+                return item
+
+    def run(self):
+        while True:
+            item = self.next()
+            if item is None:
+                return
+
+            self.limiter.wait()
+            self.deliver(*item)
+
+    def deliver(self, message, text):
+        try:
+            call_with_retry(lambda: telegram_call(getattr(message, "bot", None), "sendMessage",
+                                                  lambda: message.reply_text(text=text)))
+        except TelegramError as tgerr:
+            logger.error("reply to [%s] failed - %s" % (message.chat_id, tgerr))
+
 
 #############################################################################
 
 
-db = Database()
-channels = db.load()
+class App(object):
+    """
+    the bot's shared state. nothing touches Redis until db or channels is first
+    used, so importing the module, or a CLI run that never needs them, stays cheap.
+    """
+
+    def __init__(self, database=Database, base_url=None, random_bot=get_random_bot):
+        self.database = database
+        self.base_url = base_url
+        self.random_bot = random_bot
+        self.opened = None
+        self.loaded = None
+        self.feed = None
+        self.list_cache = ListCache()
+        self.lookup_cache = LookupCache()
+        self.outbox = Outbox()
+        self.bots = {}
+        self.refreshing = False
+        self.lock = threading.RLock()
+
+    @property
+    def db(self):
+        with self.lock:
+            if self.opened is None:
+                self.opened = WriteBehind(self.database())
+                atexit.register(self.opened.flush)
+            return self.opened
+
+    @property
+    def channels(self):
+        with self.lock:
+            if self.loaded is None:
+                self.reload()
+            return self.loaded
+
+    def reload(self):
+        with self.lock:
+            loaded = self.db.load()
+            self.list_cache.clear()
+            loaded.watch(self.list_cache.changed)
+            self.loaded = loaded
+            return loaded
+
+    def apply_change(self, op, name, raw):
+        if op == "set":
+            self.channels.add(decode_channel(raw))
+        elif op == "merge":
+            fields, raw = raw.split("\n", 1)
+            self.merge_change(decode_channel(raw), fields.split(","))
+        elif op == "del":
+            self.channels.remove(Channel(name))
+        elif op == "reload":
+            self.reload()
+
+    def merge_change(self, stored, fields):
+        """ copies only the fields another process wrote into our record, adding it when we never had it """
+        with self.channels.lock:
+            current = self.channels.get(stored)
+            if current is None:
+                self.channels.add(stored)
+                return
+
+            for field in fields:
+                if field == "count":
+                    self.channels.update_count(current, stored.count)
+                elif field == "stage":
+                    self.channels.update_stage(current, stored.stage)
+                else:
+                    setattr(current, field, getattr(stored, field))
+
+    def query(self, low, high, stage=None, exclude=None):
+        """ a list view's channels, from the storage's indexes when it has them, else from the loaded channels """
+        if self.db.indexed:
+            return self.db.query(low, high, stage, exclude)
+        return self.channels.query(low, high, stage=stage, exclude=exclude)
+
+    def api_bot(self, tgbot):
+        """ tgbot itself, or the same token talking to base_url when one is set, e.g. fake_telegram.py """
+        if self.base_url is None:
+            return tgbot
+
+        with self.lock:
+            bot = self.bots.get(tgbot.token)
+            if bot is None:
+                bot = self.bots[tgbot.token] = telegram.Bot(tgbot.token, base_url=self.base_url)
+            return bot
+
+    def follow_changes(self):
+        """ subscribes to other processes' writes where the storage has a feed, then reloads """
+        self.feed = self.db.db.feed(self.apply_change)
+        if self.feed is not None:
+            self.feed.start()
+        self.reload()
+
+
+app = App(database=database_from_url(os.environ.get("PROMOTE_IT_STORAGE")),
+          base_url=os.environ.get("TELEGRAM_BASE_URL"))
+
+
+def telegram_call(tgbot, method, func):
+    return metrics.call("telegram", func, method=method, bot=bot_label(tgbot))
+
+
+def fetch_channel_from_telegram(tgbot, name):
+    count = telegram_call(tgbot, "getChatMembersCount", lambda: tgbot.getChatMembersCount(chat_id=name))
+    username = telegram_call(tgbot, "getChat", lambda: tgbot.getChat(name)).username
+    return count, "@%s" % username, time.time()
+
+
+def call_with_retry(func, limiter=None, attempts=5, base_delay=1, max_delay=60):
+    """
+    calls func, waiting out telegram flood control (RetryAfter) and backing off
+    exponentially with jitter on network errors; gives up after attempts tries.
+    bad requests, like an unknown chat, are raised straight away.
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            return func()
+        except RetryAfter as tgerr:
+            if attempt == attempts:
+                raise
+            delay = tgerr.retry_after
+        except NetworkError as tgerr:
+            if isinstance(tgerr, BadRequest) or attempt == attempts:
+                raise
+            delay = min(max_delay, base_delay * 2 ** (attempt - 1)) * random.uniform(0.5, 1.5)
+
+        logger.warning("%s, retry [%d/%d] in [%.1f] secs" % (tgerr, attempt, attempts - 1, delay))
+        if limiter is not None:
+            limiter.defer(delay)
+            limiter.wait()
+        else:
+            time.sleep(delay)
+
 
+def lookup_channel(tgbot, name, cached=True, limiter=None):
+    return app.lookup_cache.get(name, lambda: call_with_retry(lambda: fetch_channel_from_telegram(tgbot, name), limiter),
+                            bypass=not cached)
 
-def refresh_channel_from_telegram(channel, bot=None):
+
+def refresh_channel_from_telegram(channel, bot=None, cached=True):
     tgbot = bot
     if tgbot is None:
-        tgbot = get_random_bot()
+        tgbot = app.api_bot(app.random_bot())
 
     try:
-        channel.count = tgbot.getChatMembersCount(chat_id=channel.name)
-        channel.name = "@%s" % tgbot.getChat(channel.name).username
+        channel.count, channel.name, date = lookup_channel(tgbot, channel.name, cached)
+        channel.update_date(date)
         logger.info("Got [%d] count for [%s] channe from telegram" % (channel.count, channel.name))
     except TelegramError as tgerr:
         logger.error(tgerr)
@@ -160,188 +1734,291 @@ def refresh_channel_from_telegram(channel, bot=None):
     return channel
 
 
+def reply(update, text):
+    app.outbox.send(update.message, text)
+
+
 def on_new_channel(bot, update, channel):
     channel = refresh_channel_from_telegram(channel)
 
-    channels.remove(channel)
-    channels.add(channel)
-    db.store(channels)
+    app.channels.remove(channel)
+    app.channels.add(channel)
+    app.db.store_channel(channel)
 
     logger.info("on_new_channel - #added %s" % channel.name)
     channel.log()
 
-    update.message.reply_text(text="#added %s" % channel.name)
+    reply(update, "#added %s" % channel.name)
 
 
 def on_confirm_channel(bot, update, channel):
     channel = refresh_channel_from_telegram(channel)
 
-    existing = channels.get(channel)
+    existing = app.channels.get(channel)
     if existing is None:
         logger.info("on_confirm_channel - #notfound %s" % channel.name)
-        update.message.reply_text(text="#notfound %s" % channel.name)
+        reply(update, "#notfound %s" % channel.name)
         return
 
-    existing.update_stage("#confirm")
-    existing.update_count(channel.count)
+    app.channels.update_stage(existing, "#confirm")
+    app.channels.update_count(existing, channel.count)
     existing.log()
-    db.store(channels)
+    app.db.store_channel(existing, ["stage", "count"])
     logger.info("on_confirm_channel - #confirmed %s" % channel.name)
 
-    update.message.reply_text(text="#confirmed %s" % channel.name)
+    reply(update, "#confirmed %s" % channel.name)
 
 
 def on_shared_channel(bot, update, channel):
-    existing = channels.get(channel)
+    existing = app.channels.get(channel)
     if existing is None:
         logger.info("on_shared_channel - #notfound %s" % channel.name)
-        update.message.reply_text(text="#notfound %s" % channel.name)
+        reply(update, "#notfound %s" % channel.name)
         return
 
-    existing.update_stage("#shared")
+    app.channels.update_stage(existing, "#shared")
     existing.log()
-    db.store(channels)
+    app.db.store_channel(existing, ["stage"])
     logger.info("on_shared_channel - #shared %s" % channel.name)
 
-    update.message.reply_text(text="#shared %s" % channel.name)
+    reply(update, "#shared %s" % channel.name)
 
 
 def on_remove_channel(bot, update, channel):
     channel = refresh_channel_from_telegram(channel)
 
-    removed = channels.remove(channel)
+    removed = app.channels.remove(channel)
     if removed is False:
         logger.info("on_remove_channel - #notfound %s" % channel.name)
-        update.message.reply_text(text="#notfound %s" % channel.name)
+        reply(update, "#notfound %s" % channel.name)
         return
 
-    db.store(channels)
+    app.db.delete_channel(channel)
 
     logger.info("on_remove_channel - #removed %s" % channel.name)
-    update.message.reply_text(text="#removed %s" % channel.name)
+    reply(update, "#removed %s" % channel.name)
 
 
-def on_list_channel_names(bot, update, type, low, high):
-    logger.info("on_list_channel_names - [%s][%d][%d]" % (type, low, high))
+def chunk_lines(lines, footer, limit=3500):
+    messages = []
+    chunk = []
+    size = 0
+    for line in lines:
+        chunk.append(line)
+        size = size + len(line)
+        if size > limit:
+            messages.append("".join(chunk))
+            chunk = []
+            size = 0
 
-    channel_names = channels.range_names(low, high)
+    chunk.append(footer)
+    messages.append("".join(chunk))
+    return messages
 
-    text = ""
-    for name in channel_names:
-        text += name + "\n"
-    text += "\n#%s #%dchannels" % (type, len(channel_names))
 
-    logger.info("\n%s" % text)
-    update.message.reply_text(text=text)
+def render_channels(type, low, high):
+    channels_list = app.channels.range_list(low, high)
 
+    messages = chunk_lines([channel.format() + "\n" for channel in channels_list],
+                           "\n#%s #%dchannels" % (type, len(channels_list)))
+    if len(messages) > 1:
+        messages.append("Hey, total [%d] msgs, okay !!" % len(messages))
+    return messages
 
-def on_list_channels(bot, update, type, low, high):
-    logger.info("on_list_channels - [%s][%d][%d]" % (type, low, high))
 
-    channels_list = channels.range_list(low, high)
+def render_channel_names(type, low, high):
+    channel_names = app.channels.range_names(low, high)
 
-    no = 1
-    text = ""
-    for channel in channels_list:
-        text += channel.format() + "\n"
-         
-        if len(text) > 3500: 
-            update.message.reply_text(text=text)
-            text = ""
-            no = no + 1
-            time.sleep(1)
-            
-    text += "\n#%s #%dchannels" % (type, len(channels_list))
+    return chunk_lines([name + "\n" for name in channel_names],
+                       "\n#%s #%dchannels" % (type, len(channel_names)))
 
-    logger.info("\n%s" % text)
-    update.message.reply_text(text=text)
 
-    if no > 1:
-        update.message.reply_text(text="Hey, total [%d] msgs, okay !!" % no)
+def render_stage_channels(type, low, high, tag, stage=None, exclude=None):
+    channels_list = app.query(low, high, stage=stage, exclude=exclude)
 
+    return chunk_lines([channel.name + "\n" for channel in channels_list],
+                       "\n#%s %s #%dchannels" % (type, tag, len(channels_list)))
 
-def on_refresh_channels(bot, update):
-    logger.info("on_refresh_channels %s" % "#refreshing")
-    update.message.reply_text(text="#refreshing")
 
-    channels_list = channels.list()
-    for channel in channels_list:
-        channel.count = bot.getChatMembersCount(chat_id=channel.name)
+def render_confirmed_channels(type, low, high):
+    return render_stage_channels(type, low, high, "#confirmed", stage="#confirm")
 
-    db.store(channels)
 
-    logger.info("on_refresh_channels %s" % "#refreshed")
+def render_not_confirmed_channels(type, low, high):
+    return render_stage_channels(type, low, high, "#notconfirmed", exclude="#confirm")
 
-    update.message.reply_text(text="#refreshed")
-    on_list_channels(bot, update)
 
+def render_shared_channels(type, low, high):
+    return render_stage_channels(type, low, high, "#shared", stage="#shared")
 
-def handle_message(bot, update, text):
-    text = " ".join(text.split('\n'))
 
-    logger.info("handle_message - %s" % text)
+renderers = {
+    "list": render_channels,
+    "names": render_channel_names,
+    "confirmed": render_confirmed_channels,
+    "notconfirmed": render_not_confirmed_channels,
+    "shared": render_shared_channels,
+}
 
-    m = newp.match(text)
-    if m:
-        channel = Channel(name=m.group(2), desc=m.group(3), stage=m.group(1))
-        return on_new_channel(bot, update, channel)
 
-    m = confirmp.match(text)
-    if m:
-        channel = Channel(name=m.group(2), desc=m.group(3), stage=m.group(1))
-        return on_confirm_channel(bot, update, channel)
+def render_list(view, type, low, high):
+    key = (view, type, low, high)
 
-    m = sharedp.match(text)
-    if m:
-        channel = Channel(name=m.group(2), stage=m.group(1))
-        return on_shared_channel(bot, update, channel)
+    messages, generation = app.list_cache.get(key)
+    if messages is None:
+        messages = renderers[view](type, low, high)
+        app.list_cache.put(key, messages, generation)
+        logger.info("\n%s" % messages[-1])
 
-    m = removep.match(text)
-    if m:
-        channel = Channel(name=m.group(2), stage=m.group(1))
-        return on_remove_channel(bot, update, channel)
+    return messages
 
 
-def split_text(text):
-    for hashtag in re.findall('.*(#\w+).*', text):
-        text = text.replace(hashtag, hashtag.lower())
+def reply_list(update, messages):
+    for text in messages:
+        reply(update, text)
 
-    texts = []
 
-    if "#new" in text:
-        for s in text.split("#new"):
-            if len(s) > 0:
-                s = "#new " + s
-                texts.append(s)
+def on_list_channel_names(bot, update, type, low, high):
+    logger.info("on_list_channel_names - [%s][%d][%d]" % (type, low, high))
 
-    elif "#confirm" in text:
-        for s in re.findall(".*(\@\w+).*", text):
-            s = "#confirm " + s
-            texts.append(s)
+    reply_list(update, render_list("names", type, low, high))
 
-    elif "#shared" in text:
-        for s in re.findall(".*(\@\w+).*", text):
-            s = "#shared " + s
-            texts.append(s)
 
-    elif "#remove" in text:
-        for s in re.findall(".*(\@\w+).*", text):
-            s = "#remove " + s
-            texts.append(s)
+def on_list_channels(bot, update, type, low, high):
+    logger.info("on_list_channels - [%s][%d][%d]" % (type, low, high))
 
-    else:
-        texts.append(text)
+    reply_list(update, render_list("list", type, low, high))
 
-    return texts
+
+def on_refresh_channels(bot, update, args):
+    """ starts a refresh over the bot pool in the background and replies when it is done """
+    usage = "/refresh [stale_after_secs] [no_of_bots]"
+    try:
+        stale_after = int(args[0]) if len(args) > 0 else None
+        no_of_bots = int(args[1]) if len(args) > 1 else 1
+    except ValueError:
+        reply(update, usage)
+        return
+    if no_of_bots < 1:
+        reply(update, usage)
+        return
+
+    # before taking the flag, so a failed load cannot leave it set
+    channels_list = refresh_list(stale_after)
+
+    with app.lock:
+        if app.refreshing:
+            reply(update, "#refreshing already, try again when it is done")
+            return
+        app.refreshing = True
+
+    logger.info("on_refresh_channels %s [%d]" % ("#refreshing", len(channels_list)))
+    reply(update, "#refreshing %d channels with %d bots" % (len(channels_list), no_of_bots))
+
+    def run():
+        try:
+            bots = [app.api_bot(app.random_bot(i)) for i in range(no_of_bots)]
+            refresh_channels(channels_list, bots)
+            logger.info("on_refresh_channels %s" % "#refreshed")
+            reply(update, "#refreshed")
+            on_list_channels(bot, update, "all", 0, 1000000)
+        except Exception as e:
+            logger.exception("on_refresh_channels failed")
+            reply(update, "#refresh failed - %s" % e)
+        finally:
+            with app.lock:
+                app.refreshing = False
+
+    worker = threading.Thread(target=run)
+    worker.daemon = True
+    worker.start()
+
+
+def handle_message(bot, update, command):
+    verb, name, desc = command
+
+    logger.info("handle_message - %s %s %s" % (verb, name, desc or ""))
+
+    channel = Channel(name=name, desc=desc, stage=verb)
+
+    if verb == "#new":
+        return on_new_channel(bot, update, channel)
+    if verb == "#confirm":
+        return on_confirm_channel(bot, update, channel)
+    if verb == "#shared":
+        return on_shared_channel(bot, update, channel)
+    if verb == "#remove":
+        return on_remove_channel(bot, update, channel)
+
+
+def split_text(text):
+    """
+    tokenizes a pasted admin message into (verb, name, desc) commands in one pass.
+
+    #new splits the message at every #new, each piece naming its last @handle
+    followed by the description; #confirm, #shared and #remove take the last
+    @handle of every line. hashtags are matched lower cased.
+    """
+    tokens = []
+    found = set()
+    chunks = []
+    last = 0
+
+    for m in tokenp.finditer(text):
+        token = m.group()
+        if token[0] == "#":
+            token = token.lower()
+            chunks.append(text[last:m.start()])
+            chunks.append(token)
+            last = m.end()
+            for verb in verbs:
+                if token.startswith(verb):
+                    found.add(verb)
+        tokens.append((m.start(), m.end(), token))
+
+    chunks.append(text[last:])
+    text = "".join(chunks)
+
+    commands = []
+
+    if "#new" in found:
+        handle = None
+        for start, end, token in tokens + [(len(text), len(text), "#new")]:
+            if token[0] == "@":
+                handle = (end, token)
+            elif token.startswith("#new"):
+                if handle is not None:
+                    desc = text[handle[0]:start].replace("\n", " ")
+                    commands.append(("#new", handle[1], desc))
+                handle = None
+        return commands
+
+    for verb in verbs[1:]:
+        if verb in found:
+            handle = None
+            for start, end, token in tokens + [(len(text), len(text), "\n")]:
+                if token[0] == "@":
+                    handle = token
+                elif token == "\n":
+                    if handle is not None:
+                        commands.append((verb, handle, None))
+                    handle = None
+            return commands
+
+    return commands
 
 
 def on_message(bot, update):
     if not is_admin(update):
         return
 
-    for text in split_text(update.message.text):
-        handle_message(bot, update, text)
-        time.sleep(1)
+    handle_text(bot, update)
+
+
+def handle_text(bot, update):
+    with app.db.batch():
+        for command in split_text(update.message.text):
+            handle_message(bot, update, command)
 
 
 def on_start_command(bot, update):
@@ -349,14 +2026,16 @@ def on_start_command(bot, update):
     if not is_admin(update):
         return
 
-    global channels
-    channels = db.load()
+    app.reload()
 
     text = "Hey, welcome \n\n" \
            "#new <name> <desc>\n" \
            "#confirm <name> \n" \
            "#shared <name> \n" \
            "#remove <name> \n\n" \
+           "/refresh [stale_after_secs] [no_of_bots] \n" \
+           "/stats \n\n" \
+           "/list <low> <high|plus> [names|confirmed|notconfirmed|shared|final] \n\n" \
            "/list_all \n" \
            "/list_all_names \n\n" \
            "/list_0_500 \n" \
@@ -380,215 +2059,243 @@ def on_start_command(bot, update):
            "/list_5000_plus_notconfirmed \n" \
            "/list_5000_plus_final \n"
 
-    update.message.reply_text(text=text)
+    reply(update, text)
 
 
-def on_refresh_command(bot, update):
+def on_stats_command(bot, update):
     if not is_admin(update):
         return
-    on_refresh_channels(bot, update)
-
 
-def on_list_all_command(bot, update):
-    if not is_admin(update):
-        return
-    on_list_channels(bot, update, "all", 0, 1000000)
+    with app.channels.lock:
+        rows = app.channels.stats.rows()
 
+    text = ""
+    label = None
+    for bucket, stage, channels, members in rows:
+        if bucket != label:
+            label = bucket
+            totals = [(c, m) for b, _, c, m in rows if b == bucket]
+            text += "\n#%s #%dchannels #%dreach\n" % (bucket, sum(c for c, _ in totals), sum(m for _, m in totals))
+        text += "  %s %d / %d\n" % (stage or "-", channels, members)
+    text += "\n#all #%dchannels #%dreach" % (sum(r[2] for r in rows), sum(r[3] for r in rows))
 
-def on_list_all_names_command(bot, update):
-    if not is_admin(update):
-        return
-    on_list_channel_names(bot, update, "all", 0, 1000000)
+    reply(update, text.strip())
 
 
-def on_list_0_500_command(bot, update):
+def on_refresh_command(bot, update, args):
     if not is_admin(update):
         return
-    on_list_channels(bot, update, "0_500_list", 0, 500)
-
-
-def on_list_0_500_names_command(bot, update):
+    on_refresh_channels(bot, update, args)
+
+
+list_buckets = [("0_500", 0, 500), ("500_1000", 500, 1000), ("1000_5000", 1000, 5000), ("5000_plus", 5000, 1000000)]
+list_views = ["list", "names", "confirmed", "notconfirmed", "shared", "final"]
+
+# (command, view, type, low, high), kept as shortcuts for /list
+list_aliases = [("list_all", "list", "all", 0, 1000000),
+                ("list_all_names", "names", "all", 0, 1000000)]
+for bucket, low, high in list_buckets:
+    list_aliases.append(("list_%s" % bucket, "list", "%s_list" % bucket, low, high))
+    list_aliases.append(("list_%s_names" % bucket, "names", "%s_names" % bucket, low, high))
+    list_aliases.append(("list_%s_confirmed" % bucket, "confirmed", "%s_list" % bucket, low, high))
+    list_aliases.append(("list_%s_notconfirmed" % bucket, "notconfirmed", "%s_list" % bucket, low, high))
+    list_aliases.append(("list_%s_final" % bucket, "final", "%s_list" % bucket, low, high))
+
+
+def on_list_query(bot, update, view, type, low, high, args):
+    if view == "final":
+        return on_list_final(bot, update, type, low, high, args)
+    if view == "names":
+        return on_list_channel_names(bot, update, type, low, high)
+    if view == "list":
+        return on_list_channels(bot, update, type, low, high)
+    if view == "confirmed":
+        return on_list_confirmed_channels(bot, update, type, low, high)
+    if view == "notconfirmed":
+        return on_list_not_confirmed_channels(bot, update, type, low, high)
+    if view == "shared":
+        return on_list_shared_channels(bot, update, type, low, high)
+
+
+def on_list_command(bot, update, args):
     if not is_admin(update):
         return
-    on_list_channel_names(bot, update, "0_500_names", 0, 500)
 
-
-def on_list_0_500_confirmed_command(bot, update):
-    if not is_admin(update):
-        return
-    on_list_confirmed_channels(bot, update, "0_500_list", 0, 500)
+    list_command(bot, update, args)
 
 
-def on_list_0_500_notconfirmed_command(bot, update):
-    if not is_admin(update):
+def list_command(bot, update, args):
+    usage = "/list <low> <high|plus> [%s] ..." % "|".join(list_views[1:])
+    if len(args) < 2:
+        reply(update, usage)
         return
-    on_list_not_confirmed_channels(bot, update, "0_500_list", 0, 500)
-
 
-def on_list_0_500_final_command(bot, update, args):
-    if not is_admin(update):
-        return
-    on_list_final(bot, update, "0_500_list", 0, 500, args)
-
-
-def on_list_500_1000_command(bot, update):
-    if not is_admin(update):
-        return
-    on_list_channels(bot, update, "500_1000_list", 500, 1000)
-
-
-def on_list_500_1000_names_command(bot, update):
-    if not is_admin(update):
+    try:
+        low = int(args[0])
+        high = 1000000 if args[1] == "plus" else int(args[1])
+    except ValueError:
+        reply(update, usage)
         return
-    on_list_channel_names(bot, update, "500_1000_names", 500, 1000)
-
 
-def on_list_500_1000_confirmed_command(bot, update):
-    if not is_admin(update):
+    view = "list"
+    if len(args) > 2:
+        view = args[2]
+    if view not in list_views:
+        reply(update, usage)
         return
-    on_list_confirmed_channels(bot, update, "500_1000_list", 500, 1000)
 
+    type = "%s_%s_%s" % (args[0], args[1], "names" if view == "names" else "list")
+    on_list_query(bot, update, view, type, low, high, args[3:])
 
-def on_list_500_1000_notconfirmed_command(bot, update):
-    if not is_admin(update):
-        return
-    on_list_not_confirmed_channels(bot, update, "500_1000_list", 500, 1000)
-
-
-def on_list_500_1000_final_command(bot, update, args):
-    if not is_admin(update):
-        return
-    on_list_final(bot, update, "500_1000_list", 500, 1000, args)
 
+def list_alias_command(view, type, low, high):
+    def on_list_alias_command(bot, update, args):
+        if not is_admin(update):
+            return
+        on_list_query(bot, update, view, type, low, high, args)
+    return on_list_alias_command
 
-def on_list_1000_5000_command(bot, update):
-    if not is_admin(update):
-        return
-    on_list_channels(bot, update, "1000_5000_list", 1000, 5000)
 
+def on_list_confirmed_channels(bot, update, type, low, high):
+    logger.info("on_list_confirmed_channels")
 
-def on_list_1000_5000_names_command(bot, update):
-    if not is_admin(update):
-        return
-    on_list_channel_names(bot, update, "1000_5000_names", 1000, 5000)
+    reply_list(update, render_list("confirmed", type, low, high))
 
 
-def on_list_1000_5000_confirmed_command(bot, update):
-    if not is_admin(update):
-        return
-    on_list_confirmed_channels(bot, update, "1000_5000_list", 1000, 5000)
+def on_list_not_confirmed_channels(bot, update, type, low, high):
+    logger.info("on_list_not_confirmed_channels")
 
+    reply_list(update, render_list("notconfirmed", type, low, high))
 
-def on_list_1000_5000_notconfirmed_command(bot, update):
-    if not is_admin(update):
-        return
-    on_list_not_confirmed_channels(bot, update, "1000_5000_list", 1000, 5000)
 
+def on_list_shared_channels(bot, update, type, low, high):
+    logger.info("on_list_shared_channels")
 
-def on_list_1000_5000_final_command(bot, update, args):
-    if not is_admin(update):
-        return
-    on_list_final(bot, update, "1000_5000_list", 1000, 5000, args)
+    reply_list(update, render_list("shared", type, low, high))
 
 
-def on_list_5000_plus_command(bot, update):
-    if not is_admin(update):
-        return
-    on_list_channels(bot, update, "5000_plus_list", 5000, 1000000)
+def grouper(n, iterable, fillvalue=None):
+    args = [iter(iterable)] * n
+    return itertools.izip_longest(fillvalue=fillvalue, *args)
 
 
-def on_list_5000_plus_names_command(bot, update):
-    if not is_admin(update):
-        return
-    on_list_channel_names(bot, update, "5000_plus_names", 5000, 1000000)
+def partition_serpentine(channels_list, no):
+    """ deals channels, biggest first, into no lists, reversing direction every round """
+    final_channels_list = []
+    for list in range(0, no):
+        final_channels_list.append([])
 
+    flip = False
+    for i in grouper(no, sorted(channels_list, key=lambda x: x.count, reverse=True)):
+        elements = None
+        if flip:
+            elements = i[::-1]
+            flip = False
+        else:
+            elements = i
+            flip = True
 
-def on_list_5000_plus_confirmed_command(bot, update):
-    if not is_admin(update):
-        return
-    on_list_confirmed_channels(bot, update, "5000_plus_list", 5000, 1000000)
+        for e in range(0, len(elements)):
+            if elements[e] is not None:
+                final_channels_list[e].append(elements[e])
 
+    return final_channels_list
 
-def on_list_5000_plus_notconfirmed_command(bot, update):
-    if not is_admin(update):
-        return
-    on_list_not_confirmed_channels(bot, update, "5000_plus_list", 5000, 1000000)
 
+def partition_balanced(channels_list, no, improve=True):
+    """
+    splits channels into no lists of equal reach and, within one, equal length.
 
-def on_list_5000_plus_final_command(bot, update, args):
-    if not is_admin(update):
-        return
-    on_list_final(bot, update, "5000_plus_list", 5000, 1000000, args)
+    greedy LPT: channels biggest first, each to the list with the least reach
+    that still has room, in O(n log no); then, with improve, swaps of one channel
+    between the widest and the narrowest list while that narrows the spread.
+    """
+    if no < 1:
+        raise ValueError("no of lists must be at least 1, got [%d]" % no)
 
+    floor = len(channels_list) // no
+    extra = len(channels_list) % no
 
-def on_list_confirmed_channels(bot, update, type, low, high):
-    logger.info("on_list_confirmed_channels")
+    final_channels_list = [[] for _ in range(0, no)]
+    heap = [(0, 0, i) for i in range(0, no)]
 
-    channels_list = filter(lambda x: x.stage == "#confirm", channels.range_list(low, high))
+    for channel in sorted(channels_list, key=lambda x: x.count, reverse=True):
+        while True:
+            reach, size, i = heapq.heappop(heap)
+            if size < floor or (size == floor and extra > 0):
+                break
 
-    text = ""
-    for channel in channels_list:
-        text += channel.name + "\n"
-    text += "\n#%s %s #%dchannels" % (type, "#confirmed", len(channels_list))
+        if size == floor:
+            extra = extra - 1
+        final_channels_list[i].append(channel)
+        heapq.heappush(heap, (reach + channel.count, size + 1, i))
 
-    logger.info("\n%s" % text)
-    update.message.reply_text(text=text)
+    if improve:
+        improve_partition(final_channels_list)
 
+    for channels_list in final_channels_list:
+        channels_list.sort(key=lambda x: x.count, reverse=True)
+    return final_channels_list
 
-def on_list_not_confirmed_channels(bot, update, type, low, high):
-    logger.info("on_list_not_confirmed_channels")
 
-    channels_list = filter(lambda x: x.stage != "#confirm", channels.range_list(low, high))
+def improve_partition(final_channels_list, rounds=100):
+    reaches = [sum(c.count for c in channels_list) for channels_list in final_channels_list]
 
-    text = ""
-    for channel in channels_list:
-        text += channel.name + "\n"
-    text += "\n#%s %s #%dchannels" % (type, "#notconfirmed", len(channels_list))
+    for _ in range(0, rounds):
+        widest = reaches.index(max(reaches))
+        narrowest = reaches.index(min(reaches))
+        spread = reaches[widest] - reaches[narrowest]
 
-    logger.info("\n%s" % text)
-    update.message.reply_text(text=text)
+        # swapping a for b moves a.count - b.count of reach, best when closest to half the spread
+        narrow = sorted(final_channels_list[narrowest], key=lambda x: x.count)
+        counts = [c.count for c in narrow]
+        best = None
+        for a in final_channels_list[widest]:
+            j = bisect.bisect_left(counts, a.count - spread / 2.0)
+            for b in narrow[max(0, j - 1):j + 1]:
+                moved = a.count - b.count
+                if 0 < moved < spread and (best is None or abs(spread - 2 * moved) < abs(spread - 2 * best[0])):
+                    best = (moved, a, b)
 
+        if best is None:
+            return
 
-def grouper(n, iterable, fillvalue=None):
-    args = [iter(iterable)] * n
-    return itertools.izip_longest(fillvalue=fillvalue, *args)
+        moved, a, b = best
+        final_channels_list[widest].remove(a)
+        final_channels_list[narrowest].remove(b)
+        final_channels_list[widest].append(b)
+        final_channels_list[narrowest].append(a)
+        reaches[widest] = reaches[widest] - moved
+        reaches[narrowest] = reaches[narrowest] + moved
 
 
 def on_list_final(bot, update, type, low, high, args):
+    usage = "<command> <no_of_list> <emojis...>"
     if len(args) < 1:
-        update.message.reply_text("<command< <no_of_list> <emojis...>")
+        reply(update, usage)
         return
 
-    no = int(args[0])
+    try:
+        no = int(args[0])
+    except ValueError:
+        reply(update, usage)
+        return
+    if no < 1:
+        reply(update, usage)
+        return
     emojis = args[1:]
 
     if len(emojis) < no:
-        update.message.reply_text("specified [%d] lists, but only [%d] emojis" % (no, len(emojis)))
+        reply(update, "specified [%d] lists, but only [%d] emojis" % (no, len(emojis)))
         return
 
-    channels_list = filter(lambda x: x.stage == "#confirm", channels.range_list(low, high))
+    channels_list = app.query(low, high, stage="#confirm")
 
     message = "splitting [%d] channels into [%d] lists" % (len(channels_list), no)
     logger.info("on_split_list: %s", message)
-    update.message.reply_text(message)
-
-    final_channels_list = []
-    for list in range(0, no):
-        final_channels_list.append([])
-
-    flip = False
-    for i in grouper(no, channels_list):
-        elements = None
-        if flip:
-            elements = i[::-1]
-            flip = False
-        else:
-            elements = i
-            flip = True
+    reply(update, message)
 
-        for e in range(0, len(elements)):
-            if elements[e] is not None:
-                final_channels_list[e].append(elements[e])
+    final_channels_list = partition_balanced(channels_list, no)
 
     for i in range(0, len(final_channels_list)):
         channels_list = final_channels_list[i]
@@ -599,64 +2306,107 @@ def on_list_final(bot, update, type, low, high, args):
 
         text += "\n#%s #list%d #%dchannels #%dreach" % (type, i+1, len(channels_list), sum(c.count for c in channels_list))
         logger.info("\n%s" % text)
-        update.message.reply_text(text)
+        reply(update, text)
+
+    reaches = [sum(c.count for c in channels_list) for channels_list in final_channels_list]
+    message = "#%s reach per list [%d - %d], spread [%d]" % (type, min(reaches), max(reaches),
+                                                             max(reaches) - min(reaches))
+    logger.info("on_split_list: %s", message)
+    reply(update, message)
 
 
 def error(bot, update, error):
     logger.warn('update "%s" caused error "%s"' % (update, error))
-    update.message.reply_text(text=error)
+    reply(update, error)
 
 
 #############################################################################
 
-def start_bot():
+def update_recorder(path):
+    """ a handler appending every incoming update to path as a json line, for promote_it.py replay """
+    out = open(path, "a")
+    lock = threading.Lock()
+
+    def on_any_update(bot, update):
+        with lock:
+            out.write(update.to_json() + "\n")
+            out.flush()
+    return on_any_update
+
+
+def start_bot(record=None):
     from telegram.ext import Updater, CommandHandler, MessageHandler, Filters
     from tgbots import bot_token
 
-    updater = Updater(bot_token)
+    updater = Updater(bot_token, base_url=app.base_url)
 
     logger.info(updater.bot.getMe())
 
-    dp = updater.dispatcher
+    app.follow_changes()
 
-    dp.add_handler(CommandHandler("start", on_start_command))
+    compactor = threading.Thread(target=compact_journal)
+    compactor.daemon = True
+    compactor.start()
 
-    dp.add_handler(CommandHandler("list_all", on_list_all_command))
-    dp.add_handler(CommandHandler("list_all_names", on_list_all_names_command))
+    dp = updater.dispatcher
 
-    dp.add_handler(CommandHandler("list_0_500", on_list_0_500_command))
-    dp.add_handler(CommandHandler("list_0_500_names", on_list_0_500_names_command))
-    dp.add_handler(CommandHandler("list_0_500_confirmed", on_list_0_500_confirmed_command))
-    dp.add_handler(CommandHandler("list_0_500_notconfirmed", on_list_0_500_notconfirmed_command))
-    dp.add_handler(CommandHandler("list_0_500_final", on_list_0_500_final_command, pass_args=True))
+    if record is not None:
+        dp.add_handler(MessageHandler(Filters.all, update_recorder(record)), group=-1)
 
-    dp.add_handler(CommandHandler("list_500_1000", on_list_500_1000_command))
-    dp.add_handler(CommandHandler("list_500_1000_names", on_list_500_1000_names_command))
-    dp.add_handler(CommandHandler("list_500_1000_confirmed", on_list_500_1000_confirmed_command))
-    dp.add_handler(CommandHandler("list_500_1000_notconfirmed", on_list_500_1000_notconfirmed_command))
-    dp.add_handler(CommandHandler("list_500_1000_final", on_list_500_1000_final_command, pass_args=True))
+    def handler(name, callback):
+        return timed("handler", handler=name)(callback)
 
-    dp.add_handler(CommandHandler("list_1000_5000", on_list_1000_5000_command))
-    dp.add_handler(CommandHandler("list_1000_5000_names", on_list_1000_5000_names_command))
-    dp.add_handler(CommandHandler("list_1000_5000_confirmed", on_list_1000_5000_confirmed_command))
-    dp.add_handler(CommandHandler("list_1000_5000_notconfirmed", on_list_1000_5000_notconfirmed_command))
-    dp.add_handler(CommandHandler("list_1000_5000_final", on_list_1000_5000_final_command, pass_args=True))
+    dp.add_handler(CommandHandler("start", handler("start", on_start_command)))
+    dp.add_handler(CommandHandler("refresh", handler("refresh", on_refresh_command), pass_args=True))
+    dp.add_handler(CommandHandler("stats", handler("stats", on_stats_command)))
 
-    dp.add_handler(CommandHandler("list_5000_plus", on_list_5000_plus_command))
-    dp.add_handler(CommandHandler("list_5000_plus_names", on_list_5000_plus_names_command))
-    dp.add_handler(CommandHandler("list_5000_plus_confirmed", on_list_5000_plus_confirmed_command))
-    dp.add_handler(CommandHandler("list_5000_plus_notconfirmed", on_list_5000_plus_notconfirmed_command))
-    dp.add_handler(CommandHandler("list_5000_plus_final", on_list_5000_plus_final_command, pass_args=True))
+    dp.add_handler(CommandHandler("list", handler("list", on_list_command), pass_args=True))
+    for command, view, type, low, high in list_aliases:
+        dp.add_handler(CommandHandler(command, handler(command, list_alias_command(view, type, low, high)),
+                                      pass_args=True))
 
-    dp.add_handler(CommandHandler("clean_channels", clean_channels))
+    dp.add_handler(CommandHandler("clean_channels", handler("clean_channels", clean_channels)))
 
-    dp.add_handler(MessageHandler(Filters.text, on_message))
+    dp.add_handler(MessageHandler(Filters.text, handler("message", on_message)))
     dp.add_error_handler(error)
 
+    app.outbox.start()
     updater.start_polling()
 
     updater.idle()
 
+    app.outbox.stop()
+    app.db.flush()
+
+
+def compact_journal(interval=3600, retention_days=None):
+    """ folds the journal hourly, keeping retention_days of it for replay and rewind """
+    if retention_days is None:
+        retention_days = journal_retention_days
+    while True:
+        time.sleep(interval)
+        try:
+            app.db.compact(time.time() - retention_days * 86400)
+        except (redis.RedisError, sqlite3.Error) as e:
+            logger.error("journal compaction failed - %s" % e)
+
+
+def rewind_channels(until):
+    """ restores the channels as they were at until; the restore is journaled like any other write """
+    channels = app.db.replay(until)
+    app.db.store(channels)
+    logger.info("rewound to [%s], [%d] channels" % (until, len(channels.names())))
+
+
+def print_journal(tail):
+    for date, origin, op, name, raw in app.db.journal(-tail, -1):
+        channel = ""
+        if op == "set":
+            record = decode_channel(raw)
+            channel = "[%d] [%s]" % (record.count, record.stage)
+        logger.info("%s %s %s %s %s" % (time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(date)),
+                                        origin[:8], op, name, channel))
+
 
 def clean_channels(bot, update):
     if not is_admin(update):
@@ -664,30 +2414,250 @@ def clean_channels(bot, update):
 
     logger.info("clean_channels")
 
-    db.archive(channels)
-    channels.clear()
-    db.store(channels)
+    app.db.clean(app.channels)
+    app.channels.clear()
 
     logger.info("clean_channels done")
 
-def refresh_count():
-    logger.info("#refreshing")
-
-    channels_list = channels.list()
+def refresh_worker(bot, limiter, pending, refreshed, max_attempts=3):
+    """ refreshes channels off pending until it is empty, always ending with a None on refreshed """
+    try:
+        while True:
+            try:
+                channel, attempt = pending.get_nowait()
+            except Queue.Empty:
+                break
+
+            limiter.wait()
+            try:
+                count, name, date = lookup_channel(bot, channel.name, cached=False, limiter=limiter)
+            except TelegramError as tgerr:
+                if isinstance(tgerr, BadRequest) or attempt >= max_attempts:
+                    logger.error("skipping [%s] after [%d] attempts - %s" % (channel.name, attempt, tgerr))
+                    refreshed.put((channel, None))
+                else:
+                    logger.warning("requeued [%s] - %s" % (channel.name, tgerr))
+                    pending.put((channel, attempt + 1))
+                continue
+            except Exception:
+                logger.exception("skipping [%s] after an unexpected error" % channel.name)
+                refreshed.put((channel, None))
+                continue
+
+            refreshed.put((channel, Channel(name, count=count, date=date)))
+    finally:
+        refreshed.put(None)
+
+
+def refresh_list(stale_after=None):
+    if stale_after is None:
+        return app.channels.list()
+    return app.channels.stale_list(time.time() - stale_after)
+
+
+def refresh_channels(channels_list, bots, interval=2):
+    pending = Queue.Queue()
+    refreshed = Queue.Queue()
+    for channel in channels_list:
+        pending.put((channel, 1))
+
+    limiters = {}
+    workers = []
+    for bot in bots:
+        if id(bot) not in limiters:
+            limiters[id(bot)] = RateLimiter(interval)
+        workers.append(threading.Thread(target=refresh_worker,
+                                        args=(bot, limiters[id(bot)], pending, refreshed)))
+
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+
+    with app.db.batch():
+        apply_refreshed(refreshed, len(workers))
+
+
+def apply_refreshed(refreshed, running):
+    i = 0
+    skipped = 0
+    while running > 0:
+        result = refreshed.get()
+        if result is None:
+            running = running - 1
+            continue
+
+        channel, fresh = result
+        if fresh is None:
+            skipped = skipped + 1
+            continue
+
+        # the refresh only owns count and date, and only of channels still there;
+        # one removed, cleaned or reloaded away meanwhile must not come back
+        with app.channels.lock:
+            current = app.channels.get(channel)
+            if current is None:
+                skipped = skipped + 1
+                continue
+
+            name = current.name
+            if fresh.name != name:
+                # an existing record under the new name keeps its stage and desc; the old alias goes
+                app.channels.remove(current)
+                target = app.channels.get(fresh)
+                if target is not None:
+                    app.channels.update_count(target, fresh.count)
+                    target.update_date(fresh.date)
+                    current = target
+                else:
+                    current.name = fresh.name
+                    current.update_count(fresh.count)
+                    current.update_date(fresh.date)
+                    app.channels.add(current)
+            else:
+                app.channels.update_count(current, fresh.count)
+                current.update_date(fresh.date)
+        channel = current
+
+        if channel.name != name:
+            app.db.rename(name, channel, ["count", "date"])
+        else:
+            app.db.store_channel(channel, ["count", "date"])
 
-    for i in range(0, len(channels_list)):
-        bot = get_random_bot(i)
-        channel = channels_list[i];
-        channel = refresh_channel_from_telegram(channel, bot)
         logger.info(i)
         channel.log()
-        time.sleep(2)
+        i = i + 1
 
-    db.store(channels)
+    if skipped > 0:
+        logger.warning("#skipped [%d] channels" % skipped)
+
+
+def refresh_count(no_of_bots=1, interval=2, stale_after=None):
+    app.follow_changes()
+
+    channels_list = refresh_list(stale_after)
+    logger.info("#refreshing [%d] channels with [%d] bots" % (len(channels_list), no_of_bots))
+
+    bots = []
+    for i in range(0, no_of_bots):
+        bots.append(app.api_bot(app.random_bot(i)))
+
+    refresh_channels(channels_list, bots, interval)
 
     logger.info("#refreshed")
 
 
+class ReplayBot(object):
+    """ answers lookups in process: every channel exists, with a member count fixed by its name """
+
+    token = "0:replay"
+
+    def getChatMembersCount(self, chat_id):
+        return int(random.Random(chat_id.lstrip("@").lower()).lognormvariate(6.5, 1.4))
+
+    def getChat(self, chat_id):
+        return telegram.Chat(id=0, type="channel", username=chat_id.lstrip("@"))
+
+
+class ReplayMessage(object):
+    def __init__(self, text, chat_id=1, username="replay"):
+        self.text = text
+        self.chat_id = chat_id
+        self.from_user = telegram.User(id=chat_id, first_name=username, is_bot=False, username=username)
+        self.replies = 0
+        self.reply_bytes = 0
+
+    def reply_text(self, text):
+        self.replies = self.replies + 1
+        self.reply_bytes = self.reply_bytes + len(text)
+
+
+class ReplayUpdate(object):
+    def __init__(self, text):
+        self.message = ReplayMessage(text)
+
+
+def read_updates(path):
+    """
+    texts of the updates in path, one per line: recorded updates as json (what
+    start --record writes, or getUpdates results), or plain text with \\n for a
+    line break, the fake_telegram.py script format
+    """
+    texts = []
+    with open(path) as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if not line.strip():
+                continue
+
+            if line.startswith("{"):
+                update = json.loads(line)
+                text = (update.get("message") or update).get("text")
+                if text:
+                    texts.append(text)
+            else:
+                texts.append(line.decode("utf-8").replace("\\n", "\n"))
+    return texts
+
+
+def replay_text(bot, update):
+    """ what the dispatcher would run for the text, minus is_admin """
+    text = update.message.text
+    if not text.startswith("/"):
+        return handle_text(bot, update)
+
+    args = text.split()
+    command = args[0][1:].split("@")[0]
+    if command == "list":
+        return list_command(bot, update, args[1:])
+    for alias, view, type, low, high in list_aliases:
+        if alias == command:
+            return on_list_query(bot, update, view, type, low, high, args[1:])
+
+
+def replay_updates(path, repeat=1, channels=0, profile=False, sort="cumulative", top=30, dump=None):
+    """
+    runs the updates in path through the message and /list handlers against an
+    in-memory database, a ReplayBot for lookups and a reply_text that only counts
+    """
+    global app
+    app = App(database=MemoryDatabase, random_bot=lambda i=None: ReplayBot())
+
+    bot = ReplayBot()
+    with app.db.batch():
+        for i in range(channels):
+            channel = refresh_channel_from_telegram(Channel("@channel_%d" % i, "synthetic"), bot)
+            channel.update_stage(random.Random(i).choice([None, "#new", "#confirm", "#shared"]))
+            app.channels.add(channel)
+            app.db.store_channel(channel)
+
+    texts = read_updates(path)
+    updates = [ReplayUpdate(text) for _ in range(repeat) for text in texts]
+
+    def run():
+        for update in updates:
+            replay_text(bot, update)
+
+    profiler = None
+    start = time.time()
+    if profile:
+        profiler = cProfile.Profile()
+        profiler.runcall(run)
+    else:
+        run()
+    elapsed = time.time() - start
+
+    replies = sum(u.message.replies for u in updates)
+    reply_bytes = sum(u.message.reply_bytes for u in updates)
+    print("replayed [%d] updates in [%.3f] secs, [%.1f] a sec, [%d] replies of [%d] bytes, [%d] channels" %
+          (len(updates), elapsed, len(updates) / max(elapsed, 1e-9), replies, reply_bytes, len(app.channels.names())))
+
+    if profiler is not None:
+        if dump:
+            profiler.dump_stats(dump)
+        stats = pstats.Stats(profiler, stream=sys.stdout)
+        stats.sort_stats(sort).print_stats(top)
+
+
 if __name__ == '__main__':
     if len(sys.argv) < 2:
         logger.error("require arguments")
@@ -695,7 +2665,71 @@ if __name__ == '__main__':
 
     input = sys.argv[1]
 
+    def add_metrics_arguments(parser):
+        parser.add_argument("--metrics-port", type=int, default=None, help="serve metrics on localhost:port/metrics")
+        parser.add_argument("--metrics-dump", type=int, default=None, help="log metrics every secs")
+
+    def add_telegram_arguments(parser):
+        parser.add_argument("--telegram-url", default=app.base_url,
+                            help="bot api base url, e.g. http://127.0.0.1:8081/bot for fake_telegram.py "
+                                 "(default $TELEGRAM_BASE_URL)")
+
+    def start_metrics(args):
+        if args.metrics_port is not None:
+            metrics.serve(args.metrics_port)
+        if args.metrics_dump is not None:
+            metrics.dump_every(args.metrics_dump)
+
     if input == "start":
-        start_bot()
+        parser = argparse.ArgumentParser(prog="promote_it.py start")
+        add_metrics_arguments(parser)
+        add_telegram_arguments(parser)
+        parser.add_argument("--record", default=None, help="append every incoming update to this file, for replay")
+        args = parser.parse_args(sys.argv[2:])
+        app.base_url = args.telegram_url
+        start_metrics(args)
+        start_bot(args.record)
     elif input == "refresh":
-        refresh_count()
+        parser = argparse.ArgumentParser(prog="promote_it.py refresh")
+        parser.add_argument("--bots", type=int, default=1, help="no of bots refreshing in parallel")
+        parser.add_argument("--interval", type=float, default=2, help="seconds between calls per bot")
+        parser.add_argument("--stale-after", type=int, default=None, help="only refresh channels older than secs")
+        add_metrics_arguments(parser)
+        add_telegram_arguments(parser)
+        args = parser.parse_args(sys.argv[2:])
+        app.base_url = args.telegram_url
+        start_metrics(args)
+        refresh_count(args.bots, args.interval, args.stale_after)
+    elif input == "migrate":
+        app.db.migrate()
+    elif input == "compact":
+        parser = argparse.ArgumentParser(prog="promote_it.py compact")
+        parser.add_argument("--retention-days", type=float, default=journal_retention_days,
+                            help="keep this many days of the journal for replay and rewind, 0 folds it all "
+                                 "(default $PROMOTE_IT_JOURNAL_RETENTION_DAYS or 7)")
+        args = parser.parse_args(sys.argv[2:])
+        app.db.compact(time.time() - args.retention_days * 86400)
+    elif input == "rewind":
+        parser = argparse.ArgumentParser(prog="promote_it.py rewind")
+        parser.add_argument("until", type=float, help="unix time to restore the channels to")
+        args = parser.parse_args(sys.argv[2:])
+        rewind_channels(args.until)
+    elif input == "journal":
+        parser = argparse.ArgumentParser(prog="promote_it.py journal")
+        parser.add_argument("--tail", type=int, default=50, help="no of latest entries to show")
+        args = parser.parse_args(sys.argv[2:])
+        print_journal(args.tail)
+    elif input == "replay":
+        parser = argparse.ArgumentParser(prog="promote_it.py replay")
+        parser.add_argument("file", help="recorded updates as json lines, or one message text a line")
+        parser.add_argument("--repeat", type=int, default=1, help="times to run the file")
+        parser.add_argument("--channels", type=int, default=0, help="synthetic channels to start with")
+        parser.add_argument("--profile", action="store_true", help="run under cProfile and print the hot spots")
+        parser.add_argument("--sort", default="cumulative", help="pstats sort key, e.g. cumulative or tottime")
+        parser.add_argument("--top", type=int, default=30, help="no of functions in the report")
+        parser.add_argument("--dump", default=None, help="also save the raw profile here, for pstats or snakeviz")
+        parser.add_argument("--verbose", action="store_true", help="keep the handlers' info logging")
+        args = parser.parse_args(sys.argv[2:])
+        if not args.verbose:
+            logger.setLevel(logging.WARNING)
+        replay_updates(args.file, args.repeat, args.channels, args.profile, args.sort, args.top, args.dump)